@@ -0,0 +1,206 @@
+# Standard library
+from __future__ import print_function, with_statement
+# Dependencies
+import numpy as np
+# Local
+from .Statistics import _channel_axis
+
+
+def _spatial_axes(shape):
+    "Returns the two spatial axes of the image shape and the horizontal one, along which the faces are mirrored: it is the first spatial axis of (3, w, h) images (whose axes were swapped), the second one otherwise."
+    axis = _channel_axis(shape)
+    spatial = (1, 2) if axis == 0 else (0, 1)
+    mirror = 1 if axis != 0 or shape[0] == 3 else 2
+    return spatial, mirror
+
+def _crop(X, offsets, size):
+    """
+    Crops each image of the batch X at its own position with a constant number of vectorized operations.
+
+    Parameters:
+
+    * `X`: batch of images.
+    * `offsets`: tuple of two arrays, position of each crop along the two spatial axes.
+    * `size`: size of the crops along the two spatial axes.
+    """
+    spatial, mirror = _spatial_axes(X.shape[1:])
+    axes = tuple(axis + 1 for axis in spatial)
+    # View of all the windows of the batch, the crops being gathered from it
+    windows = np.lib.stride_tricks.sliding_window_view(X, size, axis=axes)
+    key = [np.arange(X.shape[0])] + [slice(None)]*(X.ndim - 1)
+    key[axes[0]], key[axes[1]] = offsets
+    crops = windows[tuple(key)]
+    # The channels of (w, h, 3) images come before the window axes
+    if _channel_axis(X.shape[1:]) == 2:
+        crops = np.moveaxis(crops, 1, -1)
+    return np.ascontiguousarray(crops)
+
+class Augmentation(object):
+    """
+    Base class of the random transformations applied to the minibatches of `YouTubeFacesDB.generate_batches()`.
+
+    A transformation processes the whole minibatch at once with NumPy operations, drawing its random parameters from the `np.random.RandomState` it receives, so that the result only depends on its seed. Subclasses implement `apply()`. A list of transformations is applied in order (see `Compose`).
+    """
+    def __call__(self, X, rng=None, margin=0):
+        """
+        Returns the transformed batch, which may be X modified in place.
+
+        Parameters:
+
+        * `X`: batch of images, of shape `(N,) + input_dim`.
+        * `rng`: `np.random.RandomState` instance (default: None, a new one).
+        * `margin`: number of pixels around the faces in the images (see the `margin` argument of `generate_ytf_database`). Default: 0.
+        """
+        return self.apply(X, np.random.RandomState() if rng is None else rng, margin)[0]
+
+    def apply(self, X, rng, margin):
+        "Returns the transformed batch and the margin left around the faces."
+        raise NotImplementedError
+
+class Compose(Augmentation):
+    "Applies a list of transformations in order."
+    def __init__(self, augmentations):
+        """
+        Parameters:
+
+        * `augmentations`: list of `Augmentation` instances.
+        """
+        self.augmentations = list(augmentations)
+
+    def apply(self, X, rng, margin):
+        for augmentation in self.augmentations:
+            X, margin = augmentation.apply(X, rng, margin)
+        return X, margin
+
+class RandomCrop(Augmentation):
+    """
+    Crops each image at a random position.
+
+    By default, the crops have the size of the faces, and move inside the margin stored around them: the images are then translated with real pixels instead of being padded.
+    """
+    def __init__(self, size=None, max_shift=None, padding=0):
+        """
+        Parameters:
+
+        * `size`: size of the crops along the two spatial axes (an integer for square crops). Default: None (the size of the faces, i.e. the images without their margin).
+        * `max_shift`: maximal distance in pixels between a crop and the center of the image. Default: None (any position inside the image).
+        * `padding`: number of zero pixels added around the images before cropping (default: 0).
+        """
+        self.size = size
+        self.max_shift = max_shift
+        self.padding = padding
+
+    def _size(self, shape, margin):
+        "Returns the size of the crops for images of the given spatial shape."
+        if self.size is None:
+            return shape[0] - 2*margin, shape[1] - 2*margin
+        if isinstance(self.size, int):
+            return self.size, self.size
+        return tuple(self.size)
+
+    def apply(self, X, rng, margin):
+        spatial, mirror = _spatial_axes(X.shape[1:])
+        size = self._size([X.shape[axis + 1] for axis in spatial], margin)
+        return self._random_crop(X, rng, size, self.padding), 0
+
+    def _random_crop(self, X, rng, size, padding):
+        "Pads the images with padding zeros and crops them at random positions at most max_shift pixels from their center."
+        spatial, mirror = _spatial_axes(X.shape[1:])
+        if padding > 0:
+            pad = [(0, 0)]*X.ndim
+            for axis in spatial:
+                pad[axis + 1] = (padding, padding)
+            X = np.pad(X, pad, mode='constant')
+        offsets = []
+        for axis, s in zip(spatial, size):
+            # Range of the positions, centered on the image
+            room = X.shape[axis + 1] - s
+            if room < 0:
+                print('Error: the crops of size', size, 'are larger than the images of shape', X.shape[1:])
+                return X
+            low, high = 0, room
+            if self.max_shift is not None:
+                low, high = max(0, room//2 - self.max_shift), min(room, room//2 + self.max_shift)
+            offsets.append(rng.randint(low, high + 1, X.shape[0]))
+        return _crop(X, offsets, size)
+
+class CenterCrop(RandomCrop):
+    "Crops the center of each image, by default removing the margin around the faces: the deterministic counterpart of `RandomCrop`, e.g. for the validation set."
+    def __init__(self, size=None):
+        """
+        Parameters:
+
+        * `size`: size of the crops along the two spatial axes (an integer for square crops). Default: None (the size of the faces).
+        """
+        RandomCrop.__init__(self, size, max_shift=0)
+
+class RandomShift(RandomCrop):
+    """
+    Translates each image by a random number of pixels, keeping the size of the faces.
+
+    The pixels of the margin stored around the faces are used first, the images being padded with zeros only for the shifts larger than the margin.
+    """
+    def __init__(self, max_shift):
+        """
+        Parameters:
+
+        * `max_shift`: maximal translation in pixels along each axis.
+        """
+        RandomCrop.__init__(self, max_shift=max_shift)
+
+    def apply(self, X, rng, margin):
+        spatial, mirror = _spatial_axes(X.shape[1:])
+        size = tuple(X.shape[axis + 1] - 2*margin for axis in spatial)
+        return self._random_crop(X, rng, size, max(0, self.max_shift - margin)), 0
+
+class RandomFlip(Augmentation):
+    "Mirrors a random part of the images horizontally."
+    def __init__(self, probability=0.5):
+        """
+        Parameters:
+
+        * `probability`: probability for an image to be mirrored (default: 0.5).
+        """
+        self.probability = probability
+
+    def apply(self, X, rng, margin):
+        spatial, mirror = _spatial_axes(X.shape[1:])
+        flipped = np.flatnonzero(rng.random_sample(X.shape[0]) < self.probability)
+        X[flipped] = np.flip(X[flipped], axis=mirror + 1)
+        return X, margin
+
+class RandomBrightness(Augmentation):
+    """
+    Changes the brightness and the contrast of each image by random amounts.
+
+    The transformation is applied after `mean_removal` or `standardize`, so the amounts are expressed in units of the transformed inputs. Raw uint8 images are clipped to [0, 255].
+    """
+    def __init__(self, max_delta=0.1, max_contrast=0.):
+        """
+        Parameters:
+
+        * `max_delta`: maximal value added to all the pixels of an image, as a fraction of the pixel range (default: 0.1).
+        * `max_contrast`: maximal relative change of the contrast: the deviations of the pixels from the mean of their image are multiplied by a factor between `1 - max_contrast` and `1 + max_contrast` (default: 0).
+        """
+        self.max_delta = max_delta
+        self.max_contrast = max_contrast
+
+    def apply(self, X, rng, margin):
+        shape = (X.shape[0],) + (1,)*(X.ndim - 1)
+        scale = 255. if X.dtype == np.uint8 else 1.
+        delta = (rng.uniform(-self.max_delta, self.max_delta, X.shape[0])*scale).reshape(shape)
+        factor = rng.uniform(1. - self.max_contrast, 1. + self.max_contrast, X.shape[0]).reshape(shape)
+        if X.dtype == np.uint8:
+            Y = X.astype('float32')
+        else:
+            Y = X
+        if self.max_contrast > 0:
+            mean = Y.reshape((X.shape[0], -1)).mean(axis=1).reshape(shape)
+            Y -= mean
+            Y *= factor.astype(Y.dtype)
+            Y += mean
+        Y += delta.astype(Y.dtype)
+        if X.dtype == np.uint8:
+            np.clip(Y, 0, 255, out=Y)
+            X[...] = np.rint(Y)
+        return X, margin
@@ -0,0 +1,320 @@
+# Standard library
+from __future__ import print_function, with_statement
+from time import time
+import os
+import json
+# Dependencies
+import numpy as np
+import h5py
+# Local
+from .Statistics import RunningStatistics, _suffixes
+
+
+class NpyFile(object):
+    """
+    Read-only access to a database exported with `export_npy()`, with the interface of the `h5py.File` objects used by `YouTubeFacesDB`.
+
+    Each array is opened with `np.load(..., mmap_mode='r')`: slices are views on the OS page cache, which is shared by all processes reading the same files.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+
+        * `path`: directory containing the exported database, or path to its `manifest.json` file.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, 'manifest.json')
+        self.filename = path
+        self._directory = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        self._arrays = manifest['arrays']
+        self._labels = np.array([[label.encode('ascii', 'ignore')] for label in manifest['labels']])
+        #: Attributes of the original HDF5 file
+        self.attrs = manifest['attrs']
+
+    def __iter__(self):
+        return iter(['labels'] + sorted(self._arrays))
+
+    def __contains__(self, name):
+        return name == 'labels' or name in self._arrays
+
+    def get(self, name):
+        "Returns the memory-mapped array called name, or None if it does not exist."
+        if name == 'labels':
+            return self._labels
+        if not name in self._arrays:
+            return None
+        return np.load(os.path.join(self._directory, self._arrays[name]), mmap_mode='r')
+
+    def __getitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        return self.get(name)
+
+    def close(self):
+        "The memory maps are released when the arrays are garbage collected."
+        pass
+
+def is_npy_database(path):
+    "Returns True if path designates a database exported with export_npy()."
+    return os.path.isfile(os.path.join(path, 'manifest.json')) or path.endswith('.json')
+
+def export_npy(filename, directory, batch_size=1000):
+    """
+    Exports a HDF5 file generated by `generate_ytf_database` to raw `.npy` files which `YouTubeFacesDB` can memory-map.
+
+    Each dataset of the HDF5 file (`X`, `Y`, `video`, `mean`...) is saved in `directory` as `<name>.npy`, and a `manifest.json` file describes the list of labels, the arrays and the attributes of the file. The exported database is opened by passing `directory` to `YouTubeFacesDB` instead of the HDF5 file.
+
+    Parameters:
+
+    * `filename`: path to the HDF5 file.
+    * `directory`: directory where the arrays will be saved (created if needed).
+    * `batch_size`: number of images copied at once (default: 1000).
+    """
+    tstart = time()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = h5py.File(filename, "r")
+    arrays = {}
+    for name in f:
+        dset = f[name]
+        if not isinstance(dset, h5py.Dataset) or name == 'labels':
+            continue
+        arrays[name] = name + '.npy'
+        out = np.lib.format.open_memmap(os.path.join(directory, arrays[name]), mode='w+', dtype=dset.dtype, shape=dset.shape)
+        for start in range(0, dset.shape[0], batch_size):
+            stop = min(start + batch_size, dset.shape[0])
+            out[start:stop, ...] = dset[start:stop, ...]
+        out.flush()
+        del out
+    manifest = {
+        'source': os.path.abspath(filename),
+        'labels': [label[0].decode('ascii') for label in f['labels']],
+        'arrays': arrays,
+        'attrs': dict((key, value.item() if hasattr(value, 'item') else value) for key, value in f.attrs.items()),
+    }
+    f.close()
+    with open(os.path.join(directory, 'manifest.json'), 'w') as out:
+        json.dump(manifest, out, indent=4)
+    print('Exported', filename, 'to', directory, 'in', time()-tstart, 'seconds.')
+
+def _open_database(path):
+    "Opens a HDF5 file or a database exported with export_npy()."
+    if is_npy_database(path):
+        return NpyFile(path)
+    return h5py.File(path, "r")
+
+class ConcatenatedDataset(object):
+    """
+    Read-only view of several datasets (or memory-mapped arrays) concatenated along their first axis, with the indexing interface of `h5py.Dataset` used by `YouTubeFacesDB`.
+
+    A read only accesses the datasets containing the requested rows, and does not copy them to a new file. If the datasets store the images with different types (float32 and uint8), the concatenation has the type float32 and the uint8 pixels are converted to [0, 1].
+    """
+    def __init__(self, parts):
+        """
+        Parameters:
+
+        * `parts`: list of datasets with the same shape apart from the first axis.
+        """
+        self._parts = parts
+        self._offsets = np.concatenate(([0], np.cumsum([part.shape[0] for part in parts]))).astype('int64')
+        #: Shape of the concatenation
+        self.shape = (int(self._offsets[-1]),) + tuple(parts[0].shape[1:])
+        #: Type of the data
+        self.dtype = parts[0].dtype if all(part.dtype == parts[0].dtype for part in parts) else np.dtype('float32')
+        #: Chunk shape of the first dataset
+        self.chunks = getattr(parts[0], 'chunks', None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def __getitem__(self, key):
+        # Only the first axis can be selected
+        if isinstance(key, tuple):
+            key = key[0]
+        if key is Ellipsis:
+            key = slice(None)
+        if isinstance(key, (int, np.integer)):
+            p = int(np.searchsorted(self._offsets, key, 'right')) - 1
+            return self._read(p, int(key) - self._offsets[p])
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            data = []
+            for p, part in enumerate(self._parts):
+                first, last = max(start, self._offsets[p]), min(stop, self._offsets[p+1])
+                if first < last:
+                    data.append(self._read(p, slice(first - self._offsets[p], last - self._offsets[p])))
+            if not data:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(data) if len(data) > 1 else data[0]
+        # List of indices: each dataset is read once, with increasing indices
+        indices = np.asarray(key, dtype='int64')
+        data = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        parts = np.searchsorted(self._offsets, indices, 'right') - 1
+        for p in np.unique(parts):
+            mask = parts == p
+            rows, inverse = np.unique(indices[mask] - self._offsets[p], return_inverse=True)
+            data[mask] = self._read(p, rows)[inverse.ravel()]
+        return data
+
+    def _read(self, p, key):
+        "Reads key in the dataset p, converting uint8 pixels to [0, 1] if the concatenation is float32."
+        data = np.asarray(self._parts[p][key, ...])
+        if data.dtype == np.uint8 and self.dtype != np.uint8:
+            data = data.astype('float32')
+            data *= 1./255.
+        return data
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        "Reads the selection source_sel into dest[dest_sel], like `h5py.Dataset.read_direct`."
+        dest[dest_sel if dest_sel is not None else Ellipsis] = self[source_sel if source_sel is not None else Ellipsis]
+
+class _ClassMeans(object):
+    "Mean image of each class of several files, computed from their class means and counts when first accessed."
+    def __init__(self, files, luts, suffix, nb_classes):
+        self._files, self._luts, self._suffix = files, luts, suffix
+        self.shape = (nb_classes,) + tuple(files[0].get('class_mean' + suffix).shape[1:])
+        self._data = None
+
+    def _compute(self):
+        if self._data is None:
+            class_sum = np.zeros(self.shape)
+            class_count = np.zeros(self.shape[0])
+            for f, lut in zip(self._files, self._luts):
+                count = np.array(f.get('class_count' + self._suffix), dtype='float64')
+                class_sum[lut] += np.array(f.get('class_mean' + self._suffix))*count.reshape((-1,) + (1,)*(len(self.shape) - 1))
+                class_count[lut] += count
+            self._data = (class_sum/np.maximum(1, class_count).reshape((-1,) + (1,)*(len(self.shape) - 1))).astype('float32')
+        return self._data
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._compute(), dtype=dtype)
+
+    def __getitem__(self, key):
+        return self._compute()[key]
+
+class MultiFile(object):
+    """
+    Read-only view of several files generated by `generate_ytf_database` (or exported with `export_npy()`) as a single database, with the interface of the `h5py.File` objects used by `YouTubeFacesDB`.
+
+    The labels of the files are merged into a single list (in order of appearance), and the labels of each file are remapped with a lookup table. The videos of a label appearing in several files are renumbered so that they stay distinct. The images are read from the files when needed (see `ConcatenatedDataset`), and the statistics of the files are merged according to their number of images.
+    """
+    def __init__(self, filenames):
+        """
+        Parameters:
+
+        * `filenames`: list of paths to HDF5 files or to directories of exported databases.
+
+        Raises a `ValueError` if the files have different margins, or no size of images with the same shape in all of them.
+        """
+        self.filename = list(filenames)
+        self._files = [_open_database(filename) for filename in self.filename]
+        error = self._check()
+        if error is not None:
+            self.close()
+            raise ValueError(error)
+        #: Attributes: the margin around the faces, which is the same in all the files, and whether the frames of the videos are sorted in all of them
+        self.attrs = {'margin': int(self._files[0].attrs.get('margin', 0)), 'sorted': all(bool(f.attrs.get('sorted', False)) for f in self._files)}
+        self._data = {}
+
+        # Unified labels and lookup tables from the labels of each file
+        names, position, self._luts = [], {}, []
+        for f in self._files:
+            lut = []
+            for label in f.get('labels'):
+                if not label[0] in position:
+                    position[label[0]] = len(names)
+                    names.append(label[0])
+                lut.append(position[label[0]])
+            self._luts.append(np.array(lut, dtype='int32'))
+        self._data['labels'] = np.array([[name] for name in names])
+
+        # Labels, and videos renumbered after the ones of the same label in the previous files
+        Y, videos = [], []
+        next_video = np.zeros(len(names), dtype='int64')
+        has_video = all('video' in f for f in self._files)
+        for f, lut in zip(self._files, self._luts):
+            y = lut[np.array(f.get('Y'))]
+            Y.append(y)
+            if has_video:
+                video = np.array(f.get('video'), dtype='int64') + next_video[y]
+                videos.append(video)
+                np.maximum.at(next_video, y, video + 1)
+        self._data['Y'] = np.concatenate(Y).astype('int32')
+        if has_video:
+            self._data['video'] = np.concatenate(videos).astype('int32')
+
+        # Images and statistics of the sizes present in all the files
+        suffixes = set(_suffixes(self._files[0]))
+        for f in self._files[1:]:
+            suffixes &= set(_suffixes(f))
+        for suffix in sorted(suffixes):
+            self._data['X' + suffix] = ConcatenatedDataset([f.get('X' + suffix) for f in self._files])
+            self._merge_statistics(suffix)
+
+    def _check(self):
+        "Returns a message describing why the files can not be combined, or None if they have a common size of images with the same shapes and margin."
+        first = self._files[0]
+        suffixes = set(_suffixes(first))
+        for f, filename in zip(self._files[1:], self.filename[1:]):
+            suffixes &= set(_suffixes(f))
+            if int(f.attrs.get('margin', 0)) != int(first.attrs.get('margin', 0)):
+                return '%s has a margin of %d pixels instead of %d in %s' % (filename, int(f.attrs.get('margin', 0)), int(first.attrs.get('margin', 0)), self.filename[0])
+        if not suffixes:
+            return 'the files ' + str(self.filename) + ' have no size of images in common'
+        for suffix in sorted(suffixes):
+            for name in ['X' + suffix, 'mean' + suffix]:
+                if not name in first:
+                    continue
+                for f, filename in zip(self._files[1:], self.filename[1:]):
+                    if name in f and f.get(name).shape[1:] != first.get(name).shape[1:]:
+                        return '%s has %s of shape %s instead of %s in %s' % (filename, name, f.get(name).shape[1:], first.get(name).shape[1:], self.filename[0])
+        return None
+
+    def _merge_statistics(self, suffix):
+        "Merges the statistics of the images of size suffix of all the files."
+        if not all('mean' + suffix in f for f in self._files):
+            return
+        shape = self._files[0].get('mean' + suffix).shape[1:]
+        stats = RunningStatistics(shape, 0)
+        has_std = all('std' + suffix in f for f in self._files)
+        for f in self._files:
+            part = RunningStatistics(shape, 0)
+            part.count = int(f.attrs['nb_statistics' + suffix]) if 'nb_statistics' + suffix in f.attrs else f.get('X' + suffix).shape[0]
+            part.mean = np.array(f.get('mean' + suffix)[0], dtype='float64')
+            if has_std:
+                part._m2 = np.array(f.get('std' + suffix)[0], dtype='float64')**2*part.count
+            stats.merge(part)
+        self._data['mean' + suffix] = stats.mean[np.newaxis, ...].astype('float32')
+        if has_std:
+            self._data['std' + suffix] = stats.std[np.newaxis, ...].astype('float32')
+            self._data['channel_mean' + suffix] = stats.channel_mean.astype('float32')
+            self._data['channel_std' + suffix] = stats.channel_std.astype('float32')
+        if all('class_mean' + suffix in f and 'class_count' + suffix in f for f in self._files):
+            self._data['class_mean' + suffix] = _ClassMeans(self._files, self._luts, suffix, len(self._data['labels']))
+
+    def __iter__(self):
+        return iter(sorted(self._data))
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def get(self, name):
+        "Returns the dataset called name, or None if it does not exist."
+        return self._data.get(name)
+
+    def __getitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        return self.get(name)
+
+    def close(self):
+        "Closes all the files."
+        for f in self._files:
+            f.close()
@@ -0,0 +1,142 @@
+# Standard library
+from __future__ import print_function, with_statement
+import collections
+# Dependencies
+import numpy as np
+
+
+class ChunkCache(object):
+    """
+    Memory-budgeted cache of the images read by `YouTubeFacesDB`.
+
+    The file is divided into blocks of consecutive rows (usually whole HDF5 chunks). The blocks read from the file are kept in memory and evicted in least-recently-used order when the budget is exceeded. Parts of the dataset (e.g. the validation set) whose size fits in the budget can also be loaded entirely in memory with `load()`.
+
+    The counters `hits` and `misses` count the samples served from memory and from the file, `evictions` the number of blocks removed from the cache.
+    """
+    def __init__(self, cache_bytes, rows, sample_bytes):
+        """
+        Parameters:
+
+        * `cache_bytes`: maximal size of the cached data in bytes.
+        * `rows`: number of rows in a block.
+        * `sample_bytes`: size in bytes of an image and its label.
+        """
+        #: Maximal size of the cached data in bytes
+        self.cache_bytes = cache_bytes
+        #: Number of rows in a block
+        self.rows = rows
+        self.sample_bytes = sample_bytes
+        #: Number of samples read from memory
+        self.hits = 0
+        #: Number of samples read from the file
+        self.misses = 0
+        #: Number of blocks evicted from the cache
+        self.evictions = 0
+        # Blocks in least-recently-used order: index -> (X, y)
+        self._blocks = collections.OrderedDict()
+        # Parts of the dataset loaded in memory: (sorted indices, X, y)
+        self._resident = []
+        # Size of the cached data, updated when blocks and parts are added or evicted
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        "Size of the cached data in bytes."
+        return self._nbytes
+
+    @property
+    def hit_rate(self):
+        "Proportion of the samples read from memory."
+        return self.hits/float(max(1, self.hits + self.misses))
+
+    def clear(self):
+        "Empties the cache and resets the counters."
+        self._blocks.clear()
+        self._resident = []
+        self._nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _evict(self, nbytes):
+        "Evicts the least recently used blocks until nbytes more bytes fit in the budget. Returns False if they can not fit."
+        while self._blocks and self.nbytes + nbytes > self.cache_bytes:
+            X, y = self._blocks.popitem(last=False)[1]
+            self._nbytes -= X.shape[0]*self.sample_bytes
+            self.evictions += 1
+        return self.nbytes + nbytes <= self.cache_bytes
+
+    def load(self, dset_X, dset_y, indices):
+        """
+        Loads the samples at indices in memory if they fit in the budget, evicting blocks if needed. Returns True if they are in memory.
+
+        Parameters:
+
+        * `dset_X`, `dset_y`: datasets containing the images and the labels.
+        * `indices`: increasing indices of the samples.
+        """
+        indices = np.asarray(indices, dtype='int64')
+        for resident, X, y in self._resident:
+            if np.array_equal(resident, indices):
+                return True
+        if len(indices) == 0 or not self._evict(len(indices)*self.sample_bytes):
+            return False
+        # Read block by block, through the cache
+        X, y = self.read(dset_X, dset_y, indices)
+        self._resident.append((indices, X, y))
+        self._nbytes += len(indices)*self.sample_bytes
+        # Blocks cached while reading
+        self._evict(0)
+        return True
+
+    def _block(self, dset_X, dset_y, b):
+        "Returns the images and labels of block b, reading it from the file if it is not in the cache."
+        if b in self._blocks:
+            # Most recently used
+            data = self._blocks.pop(b)
+            self._blocks[b] = data
+            return data, True
+        data = (np.asarray(dset_X[b*self.rows:(b+1)*self.rows, ...]), np.asarray(dset_y[b*self.rows:(b+1)*self.rows, ...], dtype='int32'))
+        if self._evict(data[0].shape[0]*self.sample_bytes):
+            self._blocks[b] = data
+            self._nbytes += data[0].shape[0]*self.sample_bytes
+        return data, False
+
+    def read(self, dset_X, dset_y, indices, out=None):
+        """
+        Returns the images and labels at indices as new arrays, read from memory when possible.
+
+        Parameters:
+
+        * `dset_X`, `dset_y`: datasets containing the images and the labels.
+        * `indices`: increasing indices of the samples.
+        * `out`: tuple of preallocated arrays (X, y) in which the samples are copied instead of new arrays (default: None).
+        """
+        indices = np.asarray(indices, dtype='int64')
+        if out is None:
+            X = np.empty((len(indices),) + dset_X.shape[1:], dtype=dset_X.dtype)
+            y = np.empty((len(indices),) + dset_y.shape[1:], dtype='int32')
+        else:
+            X, y = out[0][:len(indices)], out[1][:len(indices)]
+        # Parts of the dataset in memory
+        for resident, X_resident, y_resident in self._resident:
+            positions = np.searchsorted(resident, indices)
+            if len(indices) and positions[-1] < len(resident) and np.array_equal(resident[positions], indices):
+                self.hits += len(indices)
+                np.take(X_resident, positions, axis=0, out=X, mode='clip')
+                np.take(y_resident, positions, axis=0, out=y, mode='clip')
+                return X, y
+        # Block by block
+        if len(indices) == 0:
+            return X, y
+        blocks = indices//self.rows
+        starts = np.flatnonzero(np.concatenate(([True], blocks[1:] != blocks[:-1])))
+        stops = np.concatenate((starts[1:], [len(indices)]))
+        for start, stop in zip(starts, stops):
+            b = blocks[start]
+            (X_block, y_block), hit = self._block(dset_X, dset_y, b)
+            X[start:stop] = X_block[indices[start:stop] - b*self.rows]
+            y[start:stop] = y_block[indices[start:stop] - b*self.rows]
+            if hit:
+                self.hits += stop - start
+            else:
+                self.misses += stop - start
+        return X, y
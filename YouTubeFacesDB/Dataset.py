@@ -5,50 +5,117 @@ import re
 import os
 import copy
 import random
+import collections
 import csv
+from multiprocessing import Pool
 # Dependencies
 import numpy as np
 import h5py
 from PIL import Image
+# Local
+from .Backend import NpyFile, MultiFile, is_npy_database
+from .Cache import ChunkCache
+from .Index import SampleIndex
+from .Statistics import _suffixes, _channel_axis
+from .Augmentation import Compose
 
 
-def to_categorical(y, nb_classes=None):
+def to_categorical(y, nb_classes=None, dtype='float64', out=None):
     """
     Convert class vector (integers from 0 to nb_classes) to binary class matrix, for use with categorical_crossentropy.
 
-    Taken from Keras.
+    Taken from Keras. The matrix has the type dtype, and is written in the preallocated array out if provided.
     """
-    Y = np.zeros((len(y), nb_classes))
-    for i in range(len(y)):
-        Y[i, y[i]] = 1.
+    y = np.asarray(y).ravel()
+    if nb_classes is None:
+        nb_classes = int(np.max(y)) + 1 if len(y) else 0
+    if out is None:
+        Y = np.zeros((len(y), nb_classes), dtype=dtype)
+    else:
+        Y = out
+        Y.fill(0)
+    Y[np.arange(len(y)), y] = 1
     return Y
 
+def _runs(indices, max_length=None):
+    "Returns the starts and stops of the runs of consecutive values in the increasing array indices, split in pieces of at most max_length values."
+    indices = np.asarray(indices, dtype='int64')
+    if len(indices) == 0:
+        return indices, indices
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    first = np.concatenate(([0], breaks))
+    lengths = np.diff(np.concatenate((first, [len(indices)])))
+    starts = indices[first]
+    if max_length is None:
+        return starts, starts + lengths
+    # Split the long runs
+    nb_pieces = (lengths + max_length - 1)//max_length
+    run = np.repeat(np.arange(len(starts)), nb_pieces)
+    piece = np.arange(len(run)) - np.repeat(np.cumsum(nb_pieces) - nb_pieces, nb_pieces)
+    stops = starts + lengths
+    starts = starts[run] + piece*max_length
+    return starts, np.minimum(starts + max_length, stops[run])
+
 class YouTubeFacesDB(object):
     """
     Class allowing to interact with a HDF5 file containing a subset of the Youtube Faces dataset.
     """
-    def __init__(self, filename, mean_removal=False, output_type='vector'):
+    def __init__(self, filename, mean_removal=False, output_type='vector', raw=False, standardize=False, size=None, cache_bytes=0, label_dtype='float64', seed=None, profiler=None):
         """
         Parameters:
         
-        * `filename`: path to the HDF5 file containing the data.
+        * `filename`: path to the HDF5 file containing the data, or to the directory of a database exported with `export_npy()`, which is then memory-mapped. A list of paths opens several files as a single database (see `MultiFile`).
         * `mean_removal`: defines if the mean image should be substracted from each image.
         * `output_type`: ['integer', 'vector'] defines the output for each sample. 'integer' will return the index of the class (e.g. 3), while vector will return a vector ith nb_classes components, all zero but one (e.g. 000...00100). Default: vector. 
+        * `label_dtype`: type of the vectors with `output_type='vector'`, e.g. 'float32'. Default: 'float64'.
+        * `standardize`: [False, 'pixel', 'channel'] defines if the inputs should be standardized: 'pixel' (or True) substracts the mean image and divides each pixel by its standard deviation, 'channel' substracts the mean of each color channel and divides by its standard deviation. Default: False.
+        * `raw`: if the file was generated with `dtype='uint8'`, returns the raw uint8 pixel values instead of floats in [0, 1]. The mean is then not removed. Default: False.
+        * `size`: if the file was generated with a list of sizes, size of the images to use, e.g. 32 or (32, 32), without the margin around the faces. A file with a single size accepts its own size. Default: None (the largest one).
+        * `cache_bytes`: memory budget in bytes for caching the data read from the file. The blocks of the file (whole HDF5 chunks) are kept in memory in least-recently-used order, and the parts of the dataset which fit in the budget (e.g. the validation set) are loaded entirely in memory the first time they are used. Default: 0 (no cache).
+        * `seed`: seed of the random generator of the object, which splits the dataset and shuffles the samples (unless another seed is passed to the generators). Its state is saved by `state_dict()`. Default: None (seeded from the global `random` module, so that `random.seed()` still makes the split reproducible).
+        * `profiler`: `Profiler` recording the duration of the reading, transformation and augmentation of the data by `get()` and `generate_batches()` (in the workers too), the time spent waiting for the minibatches and the cache hits. Default: None (no measurement).
         """
         # Open the file
         self.filename = filename
-        try:
-            self.f = h5py.File(self.filename, "r")
-        except Exception:
-            print('Error:', self.filename, 'does not exist.')
+        self._open_file()
+
+        # Size of the images
+        suffix = self._select_size(size)
+        self._suffix = suffix
 
         # Data
-        self._X = self.f.get('X')
+        self._X = self.f.get('X' + suffix)
         self._y = self.f.get('Y')
 
+        #: Storage type of the images ('float32' or 'uint8')
+        self.dtype = self._X.dtype
+        self.raw = raw
+
         # Mean input
         self.mean_removal = mean_removal
-        self.mean = np.array(self.f.get('mean'))
+        self.mean = np.array(self.f.get('mean' + suffix))
+        # Subtracted in place from the float32 inputs
+        self._mean = self.mean.astype('float32') if 'mean' + suffix in self.f else None
+
+        # Standardization
+        if standardize is True:
+            standardize = 'pixel'
+        if not standardize in [False, 'pixel', 'channel']:
+            print("Error: standardize must be in [False, 'pixel', 'channel']")
+            standardize = False
+        if standardize and not 'std' + suffix in self.f:
+            print('Error:', self.filename, 'does not contain the standard deviation of the inputs, call compute_statistics() on it first.')
+            standardize = False
+        #: Standardization of the inputs [False, 'pixel', 'channel']
+        self.standardize = standardize
+        #: Standard deviation of each pixel
+        self.std = np.array(self.f.get('std' + suffix)) if 'std' + suffix in self.f else None
+        #: Mean of each color channel
+        self.channel_mean = np.array(self.f.get('channel_mean' + suffix)) if 'channel_mean' + suffix in self.f else None
+        #: Standard deviation of each color channel
+        self.channel_std = np.array(self.f.get('channel_std' + suffix)) if 'channel_std' + suffix in self.f else None
+        #: Mean image of each class (read from the file when accessed)
+        self.class_mean = self.f.get('class_mean' + suffix)
 
         # Size
         shape = self._X.shape
@@ -56,6 +123,21 @@ class YouTubeFacesDB(object):
         self.nb_samples = shape[0]
         #: Shape of the inputs
         self.input_dim = shape[1:]
+        #: Number of pixels stored around the faces on each side of the images (see the `margin` argument of `generate_ytf_database`)
+        self.margin = int(self.f.attrs.get('margin', 0))
+
+        #: Cache of the data read from the file (`ChunkCache`), or None if `cache_bytes` is 0
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = ChunkCache(cache_bytes, self._block_size(), self._sample_bytes())
+
+        #: Profiler of the loading of the data, or None
+        self.profiler = profiler
+
+        # Random generator, and passes of generate_batches() in progress or to resume for each part of the dataset
+        self._rng = random.Random(random.getrandbits(64) if seed is None else seed)
+        self._progress = {}
+        self._resume = {}
 
         # Indices
         self._indices = list(range(self.nb_samples))
@@ -74,7 +156,7 @@ class YouTubeFacesDB(object):
         #: List of labels
         self.labels = []
         for label in labels:
-            self.labels.append(str(label[0]))
+            self.labels.append(label[0].decode('ascii') if isinstance(label[0], bytes) else str(label[0]))
         #: Total number of classes
         self.nb_classes = len(self.labels)
         if not output_type in ['integer', 'vector']:
@@ -82,11 +164,70 @@ class YouTubeFacesDB(object):
             output_type = 'vector'
         #: Output type ['integer', 'vector']
         self.output_type = output_type
+        #: Type of the vectors with `output_type='vector'`
+        self.label_dtype = np.dtype(label_dtype)
 
         #: Index of the video for each frame
         self.video = self.f.get('video')
 
-    def split_dataset(self, validation_size=0.2, test_size=0.0):
+        #: Offsets of the frames of each label in the file (the frames of label i are `label_offsets[i]:label_offsets[i+1]`), or None if they are not contiguous
+        self.label_offsets = np.array(self.f.get('label_offsets')) if 'label_offsets' in self.f else None
+        #: Offsets of the frames of each video in the file, or None if they are not contiguous
+        self.video_offsets = np.array(self.f.get('video_offsets')) if 'video_offsets' in self.f else None
+        self._video_label = np.array(self.f.get('video_label')) if 'video_label' in self.f else None
+        self._video_index = np.array(self.f.get('video_index')) if 'video_index' in self.f else None
+        self._index = None
+
+        if self.standardize:
+            self._init_standardization()
+
+    def _open_file(self):
+        "Opens the HDF5 file or the memory-mapped arrays."
+        try:
+            if isinstance(self.filename, (list, tuple)):
+                self.f = MultiFile(self.filename)
+            elif is_npy_database(self.filename):
+                self.f = NpyFile(self.filename)
+            else:
+                self.f = h5py.File(self.filename, "r")
+        except Exception as e:
+            if not isinstance(self.filename, (list, tuple)) and not os.path.exists(self.filename):
+                print('Error:', self.filename, 'does not exist.')
+            else:
+                print('Error:', self.filename, 'can not be opened:', e)
+            raise
+
+    def _reopen(self):
+        "Opens the file and its datasets again, e.g. in a new process: HDF5 handles must not be shared across a fork."
+        self._open_file()
+        self._X = self.f.get('X' + self._suffix)
+        self._y = self.f.get('Y')
+        self.class_mean = self.f.get('class_mean' + self._suffix)
+        self.video = self.f.get('video')
+
+    def __getstate__(self):
+        "The file handles can not be pickled: they are reopened when unpickling."
+        state = self.__dict__.copy()
+        for name in ['f', '_X', '_y', 'class_mean', 'video']:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reopen()
+
+    @property
+    def index(self):
+        "Index of the samples of each label and video (`SampleIndex`), built when first accessed: from the offsets of sorted files, from `Y` and `video` otherwise."
+        if self._index is None:
+            if self.label_offsets is not None and self.video_offsets is not None:
+                self._index = SampleIndex.from_offsets(self.label_offsets, self.video_offsets, self._video_index)
+            else:
+                video = np.zeros(self.nb_samples, dtype='int64') if self.video is None else np.array(self.video)
+                self._index = SampleIndex.from_arrays(np.array(self._y), video, self.nb_classes)
+        return self._index
+
+    def split_dataset(self, validation_size=0.2, test_size=0.0, stratify=False):
         """
         Split the dataset into a training set, a validation set and optionally a test set.
 
@@ -94,6 +235,7 @@ class YouTubeFacesDB(object):
 
         * `validation_size`: proportion of the data in the validation set (default: 0.2)
         * `test_size`: proportion of the data in the test set (default: 0.0) 
+        * `stratify`: [False, 'label', 'video'] defines if each label should have the same proportions of samples in each set ('label'), additionally keeping all the frames of a video in the same set ('video'), which makes the proportions approximate. Default: False.
 
         The split is only internal to the object (the method returns nothing), as the actual data should be later read from disk. 
 
@@ -110,13 +252,24 @@ class YouTubeFacesDB(object):
             X_val, y_cal = db.get('val')
             X_test, y_test = db.get('test')
         """
+        if not stratify in [False, 'label', 'video']:
+            print("Error: stratify must be in [False, 'label', 'video']")
+            stratify = False
+        if stratify:
+            rng = np.random.RandomState(self._rng.randint(0, 2**31 - 1))
+            train, val, test = self.index.stratified_split(validation_size, test_size, rng, by_video=stratify == 'video')
+            self._training_indices, self._validation_indices, self._test_indices = train.tolist(), val.tolist(), test.tolist()
+            self.nb_train, self.nb_val, self.nb_test = len(train), len(val), len(test)
+            print('Training:', self.nb_train, '; Validation:', self.nb_val, '; Test:', self.nb_test, '; Total:', self.nb_samples)
+            return
+
         # Number of examples
         self.nb_val = int(self.nb_samples*validation_size)
         self.nb_test = int(self.nb_samples*test_size)
         self.nb_train = self.nb_samples - self.nb_val - self.nb_test
         # Compute the indices
         indices = copy.deepcopy(self._indices)
-        random.shuffle(indices)
+        self._rng.shuffle(indices)
         self._validation_indices = sorted(indices[:self.nb_val])
         if self.nb_test != 0:
             self._test_indices = sorted(indices[self.nb_val:self.nb_val+self.nb_test])
@@ -125,47 +278,277 @@ class YouTubeFacesDB(object):
         self._training_indices = sorted(indices[self.nb_val+self.nb_test:])
         print('Training:', self.nb_train, '; Validation:', self.nb_val, '; Test:', self.nb_test, '; Total:', self.nb_samples)
 
-    def get(self, dset='all'):
+    def get(self, dset='all', out=None, batch_size=None, rank=0, world_size=1):
         """
         Returns the whole dataset as a tuple (X, y) of numpy arrays.
 
         Parameters:
 
         * `dset`: string in ['train', 'val', 'test', 'all'] for the desired part of the dataset (default: 'all').
+        * `out`: preallocated array (e.g. a `np.memmap`) of shape `(nb_samples,) + input_dim` in which the inputs are written and which is returned. It should have the type of the returned inputs (float32, or the storage type with `raw=True`) to avoid intermediary copies (default: None).
+        * `batch_size`: maximal number of samples read at once, which bounds the temporary memory needed e.g. to convert uint8 images. Default: None (each run of consecutive samples is read at once).
+        * `rank`, `world_size`: only returns the part number rank (starting at 0) of the dataset split into world_size contiguous parts, whose sizes differ by at most one sample, e.g. to evaluate a model with several processes (default: 0, 1).
 
+        The runs of consecutive samples of the split are read as single slices directly into the returned array. With `cache_bytes`, a split which fits in the budget is loaded in memory and read from it afterwards.
         """
         if dset == 'all':
-            X = np.array(self._X)
-            y = np.array(self._y, dtype='int32')
+            indices = slice(None)
         elif dset == 'train':
-            X = np.array(self._X[self._training_indices, ...])
-            y = np.array(self._y[self._training_indices, ...], dtype='int32')
+            indices = self._training_indices
         elif dset == 'val':
-            X = np.array(self._X[self._validation_indices, ...])
-            y = np.array(self._y[self._validation_indices, ...], dtype='int32')
+            indices = self._validation_indices
         elif dset == 'test':
-            X = np.array(self._X[self._test_indices, ...])
-            y = np.array(self._y[self._test_indices, ...], dtype='int32')
+            indices = self._test_indices
         else:
             print("Error: the `dset` argument to get() must be in ['train', 'val', 'test', 'all']")
             X = np.array([[]])
             y = np.array([], dtype='int32')
+            return self._transform_data(X, y)
+        samples = self._indices if dset == 'all' else indices
+        # Contiguous part of the process
+        rank, world_size = self._check_rank(rank, world_size, 'get')
+        if world_size > 1:
+            samples = np.array_split(np.asarray(samples, dtype='int64'), world_size)[rank]
+
+        # Keep the data in memory if it fits in the cache
+        if self.cache is not None and self.cache.load(self._X, self._y, samples):
+            return self._read_resident(samples, out, batch_size)
+
+        return self._read_runs(samples, out, batch_size)
+
+    def _check_rank(self, rank, world_size, method):
+        "Returns (rank, world_size), or (0, 1) if they are invalid."
+        if world_size < 1 or not 0 <= rank < world_size:
+            print('Error: the `rank` argument to ' + method + '() must be between 0 and world_size - 1, using the whole dataset.')
+            return 0, 1
+        return rank, world_size
+
+    def _read_indices(self, dset, indices, dest):
+        "Reads the rows of a dataset at increasing indices into the array dest."
+        if isinstance(dset, np.ndarray):
+            # Memory-mapped arrays (mode='clip' avoids an intermediary buffer)
+            np.take(dset, indices, axis=0, out=dest, mode='clip')
+        else:
+            dset.read_direct(dest, np.s_[indices], np.s_[0:len(indices)])
+
+    def _read_slice(self, dset, start, stop, dest):
+        "Reads the rows start:stop of a dataset into the array dest."
+        if isinstance(dset, np.ndarray):
+            dest[...] = dset[start:stop, ...]
+        else:
+            dset.read_direct(dest, np.s_[start:stop], np.s_[0:stop-start])
 
-        return self._transform_data(X, y)
+    def _read_runs(self, indices, out=None, batch_size=None):
+        "Reads and transforms the samples at the increasing indices, reading each run of consecutive samples (split in pieces of at most batch_size samples) as a single slice directly into the output array out (allocated if None)."
+        starts, stops = _runs(indices, batch_size)
+        def read(run, X, y):
+            self._read_slice(self._y, run[0], run[1], y)
+            self._read_slice(self._X, run[0], run[1], X)
+        return self._read_pieces(list(zip(starts, stops)), stops - starts, out, read)
 
-    def _transform_data(self, X, y):
-        "Applies transformations to the data (mean_removal, output type..."
-        # Mean removal
-        if self.mean_removal:
-            X -= self.mean
+    def _read_resident(self, indices, out=None, batch_size=None):
+        "Reads and transforms the samples at the increasing indices, which are loaded in the cache, in pieces of at most batch_size samples written in the output array out (allocated if None)."
+        indices = np.asarray(indices, dtype='int64')
+        step = max(1, len(indices)) if batch_size is None else batch_size
+        pieces = [indices[start:start+step] for start in range(0, len(indices), step)]
+        return self._read_pieces(pieces, [len(piece) for piece in pieces], out, lambda piece, X, y: self.cache.read(self._X, self._y, piece, (X, y)))
 
+    def _read_pieces(self, pieces, lengths, out, read):
+        "Reads and transforms pieces of samples of the given lengths into the output array out (allocated if None). read(piece, X, y) reads the images and labels of a piece into X and y, which are rows of out when it has the storage type of the images."
+        lengths = np.asarray(lengths, dtype='int64')
+        nb_samples = int(np.sum(lengths))
+        dtype = np.dtype('float32') if self.dtype == np.uint8 and not self.raw else self.dtype
+        X = np.empty((nb_samples,) + self.input_dim, dtype=dtype) if out is None else out
+        y = np.empty((nb_samples,) + self._y.shape[1:], dtype='int32')
+        # Pieces which can not be read in X directly go through a temporary buffer
+        direct = X.dtype == self.dtype
+        if not direct and len(lengths):
+            buffer = np.empty((int(np.max(lengths)),) + self.input_dim, dtype=self.dtype)
+        position = 0
+        for piece, length in zip(pieces, lengths):
+            if self.profiler is not None:
+                tstart = time()
+            read(piece, X[position:position+length] if direct else buffer[:length], y[position:position+length])
+            if self.profiler is not None:
+                self.profiler.record('read', time() - tstart, length, length*self._sample_bytes())
+                tstart = time()
+            if direct:
+                # In place
+                self._transform_inputs(X[position:position+length])
+            else:
+                result = self._transform_inputs(buffer[:length], out=X[position:position+length] if X.dtype == np.float32 else None)
+                if not np.may_share_memory(result, X):
+                    X[position:position+length] = result
+            if self.profiler is not None:
+                self.profiler.record('transform', time() - tstart, length)
+            position += length
+        return X, self._transform_labels(y)
+
+    def _sample_bytes(self):
+        "Size in bytes of an image and its label in the file."
+        return int(np.prod(self.input_dim))*self.dtype.itemsize + 4
+
+    def _init_standardization(self):
+        "Precomputes the arrays used to standardize the inputs, broadcastable to (N,) + input_dim."
+        if self.standardize == 'pixel':
+            self._offset = self.mean.astype('float32')
+            std = self.std
+        else:
+            # Shape broadcasting the channels along their axis
+            shape = [1]*(len(self.input_dim) + 1)
+            if len(self.input_dim) == 3 and self.input_dim[0] in [1, 3]:
+                shape[1] = self.channel_mean.shape[0]
+            elif len(self.input_dim) == 3 and self.input_dim[2] == 3:
+                shape[3] = self.channel_mean.shape[0]
+            self._offset = self.channel_mean.reshape(shape).astype('float32')
+            std = self.channel_std.reshape(shape)
+        # Constant pixels are left unscaled
+        self._scale = (1./np.where(std > 0, std, 1.)).astype('float32')
+
+    def _select_size(self, size):
+        "Returns the suffix of the datasets containing the images of the desired size ('' for a file with a single size)."
+        suffixes = _suffixes(self.f)
+        if size is None:
+            # X if it exists, the largest images otherwise
+            return max(suffixes, key=lambda suffix: (suffix == '', np.prod(self.f.get('X' + suffix).shape[1:])))
+        if isinstance(size, int):
+            size = (size, size)
+        suffix = '_' + (str(size[0]) if size[0] == size[1] else str(size[0]) + 'x' + str(size[1]))
+        if suffix in suffixes:
+            return suffix
+        # The datasets of a file with a single size have no suffix: compare their shape, with the margin around the faces
+        margin = int(self.f.attrs.get('margin', 0))
+        for suffix in suffixes:
+            shape = self.f.get('X' + suffix).shape[1:]
+            axis = _channel_axis(shape)
+            if tuple(s for a, s in enumerate(shape) if a != axis) == (size[0] + 2*margin, size[1] + 2*margin):
+                return suffix
+        print('Error:', self.filename, 'does not contain images of size', size, ', using the default one.')
+        return self._select_size(None)
+
+    def _label_index(self, label):
+        "Returns the index of a label given by its index or its name."
+        if isinstance(label, (int, np.integer)):
+            return int(label)
+        return self.labels.index(label)
+
+    def _read_raw(self, indices, block=False, out=None):
+        "Reads the images and labels at indices (a slice or an increasing list of indices) without transformation, from the cache if any. If block is True, they are read with a single slice from the first to the last index. If out is a tuple of preallocated arrays (X, y), the samples are read directly in their first rows."
+        if not isinstance(indices, slice) and len(indices) > 1:
+            indices = np.asarray(indices)
+            if np.any(indices[1:] == indices[:-1]):
+                # Samples drawn several times are read once
+                unique, inverse = np.unique(indices, return_inverse=True)
+                X, y = self._read_raw(unique, block)
+                if out is None:
+                    return X[inverse], y[inverse]
+                return np.take(X, inverse, axis=0, out=out[0][:len(indices)]), np.take(y, inverse, axis=0, out=out[1][:len(indices)])
+        if self.cache is not None:
+            if isinstance(indices, slice):
+                indices = np.arange(*indices.indices(self.nb_samples))
+            return self.cache.read(self._X, self._y, indices, out)
+        if out is not None and not block:
+            X, y = out[0][:len(indices)], out[1][:len(indices)]
+            self._read_indices(self._X, indices, X)
+            self._read_indices(self._y, indices, y)
+            return X, y
+        if block:
+            indices = np.asarray(indices)
+            X = np.asarray(self._X[indices[0]:indices[-1]+1, ...])[indices - indices[0]]
+            y = np.asarray(self._y[indices[0]:indices[-1]+1, ...], dtype='int32')[indices - indices[0]]
+            return X, y
+        return np.asarray(self._X[indices, ...]), np.asarray(self._y[indices, ...], dtype='int32')
+
+    def _read(self, indices):
+        "Reads the samples at indices (a slice or an increasing list of indices) and applies the transformations."
+        return self._transform_data(*self._read_raw(indices))
+
+    def get_label(self, label):
+        """
+        Returns all the frames of a person as a tuple (X, y) of numpy arrays.
+
+        Parameters:
+
+        * `label`: index or name of the label.
+
+        If the file contains `label_offsets` (see the `sort` argument of `generate_ytf_database`), the frames are read as a single contiguous slice. Otherwise, they are found with `index`.
+        """
+        label = self._label_index(label)
+        if self.label_offsets is not None:
+            return self._read(slice(self.label_offsets[label], self.label_offsets[label+1]))
+        return self._read(self.index.label(label))
+
+    def get_video(self, label, video):
+        """
+        Returns all the frames of a video as a tuple (X, y) of numpy arrays.
+
+        Parameters:
+
+        * `label`: index or name of the label.
+        * `video`: index of the video for this label.
+
+        If the file contains `video_offsets` (see the `sort` argument of `generate_ytf_database`), the frames are read as a single contiguous slice. Otherwise, they are found with `index`.
+        """
+        label = self._label_index(label)
+        if self.video_offsets is not None:
+            v = np.flatnonzero((self._video_label == label) & (self._video_index == video))
+            if len(v) == 0:
+                return self._read(slice(0, 0))
+            return self._read(slice(self.video_offsets[v[0]], self.video_offsets[v[0]+1]))
+        v = self.index.find_video(label, video)
+        return self._read(slice(0, 0) if v is None else self.index.video(v))
+
+    def _transform_data(self, X, y, buffers=None):
+        "Applies transformations to the data (mean_removal, output type... If buffers are given (see _allocate()), the results are written in them."
+        out = buffers['X'][:X.shape[0]] if buffers is not None and 'X' in buffers else None
+        return self._transform_inputs(X, out), self._transform_labels(y, buffers)
+
+    def _transform_inputs(self, X, out=None):
+        "Applies the transformations to the inputs, in place when possible. uint8 pixels are converted to floats in out if given."
+        # Raw pixels are converted to floats in [0, 1]
+        if X.dtype == np.uint8:
+            if self.raw:
+                return X
+            if out is None:
+                X = X.astype('float32')
+                X *= 1./255.
+            else:
+                X = np.multiply(X, np.float32(1./255.), out=out)
+
+        # Memory-mapped inputs are read-only views
+        if (self.standardize or self.mean_removal) and not X.flags.writeable:
+            X = np.array(X)
+
+        # Standardization or mean removal
+        if self.standardize:
+            X -= self._offset
+            X *= self._scale
+        elif self.mean_removal:
+            X -= self._mean
+
+        return X
+
+    def _transform_labels(self, y, buffers=None):
+        "Applies the output type to the labels."
         # Categorical outputs
         if self.output_type == 'vector':
-            y = to_categorical(y, self.nb_classes)
+            y = to_categorical(y, self.nb_classes, self.label_dtype, None if buffers is None else buffers['Y'][:len(y)])
 
-        return X, y
+        return y
+
+    def _allocate(self, batch_size):
+        "Allocates the buffers in which minibatches of at most batch_size samples are read and transformed."
+        buffers = {
+            'raw': np.empty((batch_size,) + self.input_dim, dtype=self.dtype),
+            'labels': np.empty((batch_size,) + self._y.shape[1:], dtype='int32'),
+        }
+        if self.dtype == np.uint8 and not self.raw:
+            buffers['X'] = np.empty((batch_size,) + self.input_dim, dtype='float32')
+        if self.output_type == 'vector':
+            buffers['Y'] = np.empty((batch_size, self.nb_classes), dtype=self.label_dtype)
+        return buffers
 
-    def generate_batches(self, batch_size, dset='all', rest=True):
+    def generate_batches(self, batch_size, dset='all', rest=True, shuffle='global', block_size=None, buffer_size=None, workers=0, prefetch=None, seed=None, reuse_buffers=False, balanced=False, max_per_video=None, augment=None, rank=0, world_size=1):
         """
         Returns a minibatch of random samples of the DB as a (X, y) tuple every time it is called, until the dataset is fully seen.
 
@@ -174,6 +557,19 @@ class YouTubeFacesDB(object):
         * `batch_size`: number of samples per minibatch.
         * `dset`: string in ['train', 'val', 'test', 'all'] for the desired part of the dataset (default: 'all').
         * `rest`: defines if the remaining samples after the last full minibatch should be sent anyway (default: True)
+        * `shuffle`: ['global', 'block'] defines how the samples are shuffled. 'global' draws each minibatch from a random permutation of all the samples, which reads scattered rows of the file. 'block' shuffles the order of contiguous blocks of samples, reads each block at once and mixes the samples of several blocks in a shuffle buffer, which is much faster on chunked files or slow disks (default: 'global').
+        * `block_size`: number of consecutive samples read at once with `shuffle='block'`. The smaller, the more random. Default: None (whole HDF5 chunks, about 1MB).
+        * `buffer_size`: number of samples mixed in the shuffle buffer with `shuffle='block'`. The larger, the more random. Default: None (10 minibatches).
+        * `workers`: number of worker processes reading and transforming the data in the background, each with its own handle on the file. 0 reads the data in the current process (default: 0).
+        * `prefetch`: maximal number of minibatches (or blocks with `shuffle='block'`) read in advance by the workers. Default: None (twice the number of workers).
+        * `seed`: seed of the random generator shuffling the samples. For a given seed, the minibatches are the same whatever the number of workers. Default: None (the random generator of the object is used, see the `seed` argument of `YouTubeFacesDB`).
+        * `reuse_buffers`: with `shuffle='global'` and `workers=0`, reads and transforms every minibatch in the same preallocated arrays instead of allocating new ones. Each minibatch is then overwritten by the next one: copy it if it has to be kept. Default: False.
+        * `balanced`: if True, the labels are uniformly distributed in the minibatches: each sample is drawn (with replacement) by choosing a random label, then a random sample of this label. The number of minibatches is unchanged (default: False).
+        * `max_per_video`: if set, at most `max_per_video` random frames of each video are used, which are drawn again at each call (default: None).
+        * `augment`: random transformation (`Augmentation`, e.g. `RandomFlip()`) or list of transformations applied to the inputs of each minibatch after the other transformations, by the workers if any (default: None). Each minibatch (or block with `shuffle='block'`) is transformed with its own random generator, seeded from the one shuffling the samples, so the results only depend on `seed`. The crops and shifts use the margin around the faces if the file has one (see `RandomCrop`).
+        * `rank`, `world_size`: for data-parallel training with world_size processes, only sends the part number rank (starting at 0) of each pass (default: 0, 1). The processes must use the same seed, so that they draw the same permutation: it is then split into world_size disjoint parts of the same size, padded with its first samples if `rest` is True, truncated otherwise, and each process only reads its part. All the processes thus get the same number of minibatches. With `shuffle='block'`, the sequence of shuffled blocks is split.
+
+        The number of minibatches already sent is saved by `state_dict()` until the pass is complete, so that an interrupted pass can be resumed (see `load_state_dict()`).
         """     
         # Access the dataset indices 
         if dset=='train':
@@ -192,28 +588,508 @@ class YouTubeFacesDB(object):
             print("Error: the `dset` argument to get_batch() must be in ['train', 'val', 'test', 'all']")
             return
 
+        # Keep the data in memory if it fits in the cache
+        if self.cache is not None:
+            self.cache.load(self._X, self._y, indices)
+
+        if not shuffle in ['global', 'block']:
+            print("Error: the `shuffle` argument to generate_batches() must be in ['global', 'block']")
+            shuffle = 'global'
+        if balanced and shuffle == 'block':
+            print("Error: balanced minibatches can not be drawn with shuffle='block', using shuffle='global'.")
+            shuffle = 'global'
+        rng = self._rng if seed is None else random.Random(seed)
+        if isinstance(augment, (list, tuple)):
+            augment = Compose(augment)
+
+        # Progress of the pass, resumed from load_state_dict() if it was interrupted with the same arguments
+        rank, world_size = self._check_rank(rank, world_size, 'generate_batches')
+        settings = {'batch_size': batch_size, 'rest': rest, 'shuffle': shuffle, 'block_size': block_size, 'buffer_size': buffer_size, 'seed': seed, 'balanced': balanced, 'max_per_video': max_per_video, 'rank': rank, 'world_size': world_size}
+        progress = {'settings': settings, 'cursor': 0}
+        resume = self._resume.pop(dset, None)
+        if resume is not None and resume['settings'] != settings:
+            print('Error: the pass over the', dset, 'set was saved with other arguments of generate_batches(), starting a new one.')
+            resume = None
+        if resume is not None:
+            # Same random draws as the interrupted pass
+            rng.setstate(resume['rng_state'])
+            progress['cursor'] = resume['cursor']
+        progress['rng_state'] = rng.getstate()
+        self._progress[dset] = progress
+
+        # Samplers based on the index of the labels and videos
+        if balanced or max_per_video is not None:
+            np_rng = np.random.RandomState(rng.randint(0, 2**31 - 1))
+            index = self.index.restrict(indices)
+            if max_per_video is not None:
+                indices = index.cap_videos(max_per_video, np_rng).tolist()
+                index = index.restrict(indices)
+                N = len(indices)
+
+        if shuffle == 'block':
+            batches = self._generate_blocks(indices, batch_size, rest, block_size, buffer_size, workers, prefetch, rng, augment, progress['cursor'], rank, world_size)
+            for X, y in self._track(dset, progress, batches):
+                yield X, y
+            return
+
+        # Shuffle the training set
+        rng.shuffle(indices)
+
+        # Part of the process
+        if world_size > 1:
+            indices = _partition(np.asarray(indices, dtype='int64'), rank, world_size, rest).tolist()
+            N = len(indices)
+
         # Compute the number of minibatches
         nb_batches = int(N/batch_size)
         rest_batches = N - nb_batches*batch_size # what to do with the rest?
 
-        # Shuffle the training set
-        random.shuffle(indices)
+        # Sorted samples of each minibatch
+        if balanced:
+            # The samples of all the processes are drawn, each one keeping its own
+            tasks = [(np.sort(index.balanced(batch_size*world_size, np_rng)[rank*batch_size:(rank+1)*batch_size]), False) for b in range(nb_batches)]
+            if rest_batches != 0 and rest:
+                tasks.append((np.sort(index.balanced(rest_batches*world_size, np_rng)[rank*rest_batches:(rank+1)*rest_batches]), False))
+        else:
+            tasks = [(sorted(indices[b*batch_size:(b+1)*batch_size]), False) for b in range(nb_batches)]
+            # Throw the rest. May be inefficient.
+            if rest_batches != 0 and rest:
+                tasks.append((sorted(indices[nb_batches*batch_size:]), False))
+        tasks = self._augment_tasks(tasks, augment, rng)
 
-        # Iterate over the minibatches
-        for b in range(nb_batches):
-            samples = sorted(indices[b*batch_size:(b+1)*batch_size])
-            X = np.array(self._X[samples, ...])
-            y = np.array(self._y[samples, ...], dtype='int32')
-            X, y = self._transform_data(X, y)
+        # Iterate over the minibatches which were not sent yet
+        buffers = self._allocate(batch_size) if reuse_buffers and workers <= 0 else None
+        for X, y in self._track(dset, progress, self._load(tasks[progress['cursor']:], workers, prefetch, buffers)):
             yield X, y
 
-        # Throw the rest. May be inefficient.
-        if rest_batches != 0 and rest:
-            samples = sorted(indices[nb_batches*batch_size:])
-            X = np.array(self._X[samples, ...])
-            y = np.array(self._y[samples, ...], dtype='int32')
-            X, y = self._transform_data(X, y)
+    def _track(self, dset, progress, batches):
+        "Counts the minibatches sent in the progress of the pass, which is forgotten once it is complete, and records the time spent waiting for them."
+        batches = iter(batches)
+        while True:
+            if self.profiler is not None:
+                tstart = time()
+            try:
+                X, y = next(batches)
+            except StopIteration:
+                break
+            if self.profiler is not None:
+                self.profiler.record('wait', time() - tstart, X.shape[0])
+            progress['cursor'] += 1
             yield X, y
+        if self._progress.get(dset) is progress:
+            del self._progress[dset]
+
+    def state_dict(self):
+        """
+        Returns the state of the iteration over the dataset as a dictionary which can be pickled: the state of the random generator, the indices of the training, validation and test sets, and for each pass of `generate_batches()` in progress, the state of its random generator at the beginning of the pass and the number of minibatches already sent.
+
+        The minibatches are counted when they are sent: save the state after having processed a minibatch.
+        """
+        return {
+            'rng_state': self._rng.getstate(),
+            'train': np.array(self._training_indices, dtype='int64'),
+            'val': np.array(self._validation_indices, dtype='int64'),
+            'test': np.array(self._test_indices, dtype='int64'),
+            'progress': copy.deepcopy(self._progress),
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restores the state returned by `state_dict()`, e.g. in a new process after the interruption of a training job.
+
+        The split is restored, and the next call to `generate_batches()` for a pass which was in progress (with the same arguments) draws the same permutation and sends the minibatches which were not sent yet, without reading the previous ones. With `shuffle='block'`, the blocks whose samples were still in the shuffle buffer are read again.
+
+        Parameters:
+
+        * `state`: dictionary returned by `state_dict()`.
+        """
+        indices = np.concatenate((state['train'], state['val'], state['test']))
+        if len(indices) != self.nb_samples or (len(indices) and (indices.min() < 0 or indices.max() >= self.nb_samples)):
+            print('Error: the state does not correspond to the', self.nb_samples, 'samples of', self.filename)
+            return
+        self._rng.setstate(state['rng_state'])
+        self._training_indices, self._validation_indices, self._test_indices = state['train'].tolist(), state['val'].tolist(), state['test'].tolist()
+        self.nb_train, self.nb_val, self.nb_test = len(state['train']), len(state['val']), len(state['test'])
+        self._resume = copy.deepcopy(state['progress'])
+
+    def _augment_tasks(self, tasks, augment, rng):
+        "Adds the augmentation and the seed of its random generator to each (samples, block) task."
+        if augment is None:
+            return tasks
+        return [(samples, block, augment, rng.randint(0, 2**31 - 1)) for samples, block in tasks]
+
+    def _read_samples(self, samples, block=False, buffers=None, augment=None, seed=None):
+        "Reads and transforms the samples at the increasing indices samples. If block is True, they are read with a single slice from the first to the last one. If buffers are given (see _allocate()), no array is allocated. The inputs are then augmented with a random generator seeded with seed."
+        if self.profiler is not None:
+            return self._profile_samples(samples, block, buffers, augment, seed)
+        out = None if buffers is None else (buffers['raw'], buffers['labels'])
+        X, y = self._transform_data(*self._read_raw(samples, block, out), buffers=buffers)
+        if augment is not None:
+            X = self._augment(X, augment, seed)
+        return X, y
+
+    def _augment(self, X, augment, seed):
+        "Applies the augmentation to the inputs with a random generator seeded with seed."
+        # Memory-mapped inputs are read-only views
+        if not X.flags.writeable:
+            X = np.array(X)
+        return augment(X, np.random.RandomState(seed), self.margin)
+
+    def _profile_samples(self, samples, block=False, buffers=None, augment=None, seed=None):
+        "_read_samples() recording the duration of each stage in the profiler."
+        out = None if buffers is None else (buffers['raw'], buffers['labels'])
+        hits, misses = (self.cache.hits, self.cache.misses) if self.cache is not None else (0, 0)
+        tstart = time()
+        raw = self._read_raw(samples, block, out)
+        self.profiler.record('read', time() - tstart, len(samples), len(samples)*self._sample_bytes())
+        if self.cache is not None:
+            self.profiler.record('cache_hit', None, self.cache.hits - hits)
+            self.profiler.record('cache_miss', None, self.cache.misses - misses)
+        tstart = time()
+        X, y = self._transform_data(*raw, buffers=buffers)
+        self.profiler.record('transform', time() - tstart, len(samples))
+        if augment is not None:
+            tstart = time()
+            X = self._augment(X, augment, seed)
+            self.profiler.record('augment', time() - tstart, len(samples))
+        return X, y
+
+    def _load(self, tasks, workers, prefetch, buffers=None):
+        "Generates the result of _read_samples() for each (samples, block[, augment, seed]) task in order, either in the current process (reusing buffers if given) or in a pool of workers."
+        if workers <= 0:
+            for task in tasks:
+                yield self._read_samples(task[0], task[1], buffers, *task[2:])
+            return
+        if prefetch is None:
+            prefetch = 2*workers
+        # The workers reopen the file after the fork
+        pool = Pool(workers, _init_worker, (self,))
+        try:
+            # Bounded queue of pending tasks, consumed in submission order
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_read_task, (task,)))
+                if len(pending) >= max(1, prefetch):
+                    yield self._collect(pending.popleft().get())
+            while pending:
+                yield self._collect(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _collect(self, result):
+        "Returns the (X, y) result of a worker, recording the events of its profiler in the one of the current process."
+        if self.profiler is None:
+            return result
+        for event in result[2]:
+            self.profiler.record(*event)
+        return result[:2]
+
+    def _block_size(self):
+        "Returns the default number of samples per block for the block shuffling: whole HDF5 chunks of about 1MB."
+        sample_bytes = max(1, int(np.prod(self.input_dim))*self.dtype.itemsize)
+        chunks = getattr(self._X, 'chunks', None)
+        rows = chunks[0] if chunks is not None else 1
+        return rows*max(1, 2**20//(rows*sample_bytes))
+
+    def _generate_blocks(self, indices, batch_size, rest, block_size, buffer_size, workers, prefetch, rng, augment=None, skip=0, rank=0, world_size=1):
+        "Generates minibatches by reading shuffled blocks of consecutive samples and mixing them in a shuffle buffer, starting after skip minibatches. With world_size > 1, only the part rank of the sequence of shuffled blocks is used."
+        if block_size is None:
+            block_size = self._block_size()
+        if buffer_size is None:
+            buffer_size = 10*batch_size
+        indices = np.sort(np.asarray(indices, dtype='int64'))
+        if len(indices) == 0:
+            return
+        # Samples of the split falling in the same block are read with a single slice
+        blocks = np.split(indices, np.flatnonzero(np.diff(indices//block_size)) + 1)
+        rng.shuffle(blocks)
+        if world_size > 1:
+            samples = _partition(np.concatenate(blocks), rank, world_size, rest)
+            if len(samples) == 0:
+                return
+            # The padding wraps around to the first samples, which start new blocks even in the same block of the file
+            blocks = np.split(samples, np.flatnonzero((np.diff(samples//block_size) != 0) | (np.diff(samples) <= 0)) + 1)
+
+        # The transformations apply to each sample independently: the blocks are transformed before being mixed
+        buffer = _ShuffleBuffer(max(1, buffer_size))
+        writer = _BatchWriter(batch_size)
+        tasks = self._augment_tasks([(block, True) for block in blocks], augment, rng)
+        first = 0
+        if skip > 0:
+            # Replay the mixing on the positions of the samples in the concatenation of the blocks: it only depends on their number
+            sizes = np.array([len(block) for block in blocks])
+            offsets = np.concatenate(([0], np.cumsum(sizes))).astype('int64')
+            positions = _BatchWriter(batch_size)
+            flushed = False
+            while len(positions.ready) < skip and first < len(blocks):
+                buffer.push([np.arange(offsets[first], offsets[first+1])], rng, positions)
+                first += 1
+            if len(positions.ready) < skip:
+                buffer.flush(rng, positions)
+                flushed = True
+            # The rest counts as a minibatch if it was sent
+            pending = positions.ready[skip:] + ([positions.rest()] if len(positions.ready) >= skip and positions.rest() is not None else [])
+            pending = np.concatenate([batch[0] for batch in pending]) if pending else np.zeros(0, dtype='int64')
+            kept = buffer.arrays[0][:buffer.size] if buffer.arrays is not None else np.zeros(0, dtype='int64')
+            # The samples still to send are read from their blocks
+            buffer = _ShuffleBuffer(buffer.capacity)
+            needed_positions = np.concatenate((pending, kept))
+            if len(needed_positions):
+                position_blocks = np.searchsorted(offsets, needed_positions, 'right') - 1
+                needed = np.unique(position_blocks)
+                X_blocks, y_blocks = zip(*self._load([tasks[b] for b in needed], workers, prefetch))
+                starts = np.cumsum(sizes[needed]) - sizes[needed]
+                rows = starts[np.searchsorted(needed, position_blocks)] + needed_positions - offsets[position_blocks]
+                X_all, y_all = np.concatenate(X_blocks)[rows], np.concatenate(y_blocks)[rows]
+                writer.write([X_all, y_all], np.arange(len(pending)))
+                buffer.push([X_all[len(pending):], y_all[len(pending):]], rng, writer)
+            for batch in writer.ready:
+                yield batch
+            writer.ready = []
+        else:
+            flushed = False
+        for X, y in self._load(tasks[first:], workers, prefetch):
+            buffer.push([X, y], rng, writer)
+            for batch in writer.ready:
+                yield batch
+            writer.ready = []
+        if not flushed:
+            buffer.flush(rng, writer)
+            for batch in writer.ready:
+                yield batch
+
+        # Throw the rest
+        if writer.rest() is not None and rest:
+            yield writer.rest()
+
+    def _split_indices(self, dset, method):
+        "Returns the indices of the samples of a part of the dataset, or None if dset is invalid."
+        if not dset in ['train', 'val', 'test', 'all']:
+            print("Error: the `dset` argument to " + method + "() must be in ['train', 'val', 'test', 'all']")
+            return None
+        return {'train': self._training_indices, 'val': self._validation_indices, 'test': self._test_indices, 'all': self._indices}[dset]
+
+    def _read_groups(self, groups):
+        "Reads and transforms the inputs of several arrays of sample indices with a single access to the file. Returns one array of inputs per group."
+        unique, inverse = np.unique(np.concatenate(groups), return_inverse=True)
+        X = self._transform_inputs(self._read_raw(unique)[0])[inverse.ravel()]
+        return np.split(X, np.cumsum([len(group) for group in groups])[:-1])
+
+    def _tuple_sampler(self, dset, nb_batches, batch_size, exclude_same_video, seed, method):
+        "Returns the index of the part of the dataset, the number of minibatches and the random generator used by generate_pairs() and generate_triplets(), or None if no tuple can be drawn."
+        indices = self._split_indices(dset, method)
+        if indices is None:
+            return None
+        index = self.index.restrict(indices)
+        if not index.can_draw_triplets(exclude_same_video):
+            print('Error: the', dset, 'set does not contain enough labels or videos to draw pairs.')
+            return None
+        if nb_batches is None:
+            nb_batches = max(1, len(indices)//batch_size)
+        rng = np.random.RandomState(self._rng.randint(0, 2**31 - 1) if seed is None else seed)
+        return index, nb_batches, rng
+
+    def generate_pairs(self, batch_size, dset='train', nb_batches=None, exclude_same_video=False, seed=None):
+        """
+        Returns a minibatch of random pairs of images as a (X1, X2, same) tuple every time it is called, for face verification. Half of the pairs show the same person (`same` is 1), the other ones two different persons (`same` is 0).
+
+        Parameters:
+
+        * `batch_size`: number of pairs per minibatch.
+        * `dset`: string in ['train', 'val', 'test', 'all'] for the desired part of the dataset (default: 'train').
+        * `nb_batches`: number of minibatches. Default: None (as many as needed to have as many pairs as samples).
+        * `exclude_same_video`: if True, the pairs of the same person come from different videos (default: False).
+        * `seed`: seed of the random generator (default: None).
+
+        The pairs are drawn with vectorized operations on `index`, and the images of each minibatch are read with a single access to the file.
+        """
+        sampler = self._tuple_sampler(dset, nb_batches, batch_size, exclude_same_video, seed, 'generate_pairs')
+        if sampler is None:
+            return
+        index, nb_batches, rng = sampler
+        for b in range(nb_batches):
+            first, second, same = index.pairs(batch_size, rng, exclude_same_video)
+            X1, X2 = self._read_groups([first, second])
+            yield X1, X2, same
+
+    def generate_triplets(self, batch_size, dset='train', nb_batches=None, exclude_same_video=False, seed=None):
+        """
+        Returns a minibatch of random triplets of images as a (X_anchor, X_positive, X_negative) tuple every time it is called, for metric learning. The positive image shows the same person as the anchor, the negative one another person.
+
+        Parameters:
+
+        * `batch_size`: number of triplets per minibatch.
+        * `dset`: string in ['train', 'val', 'test', 'all'] for the desired part of the dataset (default: 'train').
+        * `nb_batches`: number of minibatches. Default: None (as many as needed to have as many triplets as samples).
+        * `exclude_same_video`: if True, the positive image comes from another video than the anchor (default: False).
+        * `seed`: seed of the random generator (default: None).
+
+        The triplets are drawn with vectorized operations on `index`, and the images of each minibatch are read with a single access to the file.
+        """
+        sampler = self._tuple_sampler(dset, nb_batches, batch_size, exclude_same_video, seed, 'generate_triplets')
+        if sampler is None:
+            return
+        index, nb_batches, rng = sampler
+        for b in range(nb_batches):
+            anchor, positive, negative = index.triplets(batch_size, rng, exclude_same_video)
+            X_anchor, X_positive, X_negative = self._read_groups([anchor, positive, negative])
+            yield X_anchor, X_positive, X_negative
+
+    def generate_clips(self, batch_size, length, dset='all', stride=1, step=None, padding=None, rest=True, seed=None):
+        """
+        Returns a minibatch of random clips of consecutive frames as a (X, y) tuple every time it is called, until all the clips are seen. X has the shape `(batch_size, length) + input_dim`, and y contains the label of each clip.
+
+        Parameters:
+
+        * `batch_size`: number of clips per minibatch.
+        * `length`: number of frames per clip.
+        * `dset`: string in ['train', 'val', 'test', 'all'] for the desired part of the dataset (default: 'all'). The frames of a video missing from this set are skipped, so the sets should be made with `split_dataset(stratify='video')`.
+        * `stride`: number of frames between two frames of a clip (default: 1).
+        * `step`: number of frames between the starts of two clips of a video. Default: None (the clips do not overlap).
+        * `padding`: [None, 'edge', 'zero'] defines what to do with the videos shorter than a clip: ignore them (None), or make a single clip repeating their last frame ('edge') or completing it with zeros ('zero'). Default: None.
+        * `rest`: defines if the remaining clips after the last full minibatch should be sent anyway (default: True).
+        * `seed`: seed of the random generator shuffling the clips (default: None).
+
+        The file must be generated with the `sort` argument of `generate_ytf_database` (its attribute `sorted` is then True): the frames of each video are then contiguous and in order, and each clip is read with a single slice. The order of the frames is not stored in unsorted files, whose clips could be made of shuffled frames (e.g. with `max_number` or `max_images_per_person`).
+        """
+        indices = self._split_indices(dset, 'generate_clips')
+        if indices is None:
+            return
+        if not self.f.attrs.get('sorted', False):
+            print('Error: generate_clips() needs a file whose frames are sorted by video and frame, generated with sort=True.')
+            return
+        if not padding in [None, 'edge', 'zero']:
+            print("Error: padding must be in [None, 'edge', 'zero']")
+            padding = None
+        span = (length - 1)*stride + 1
+        index = self.index.restrict(indices)
+        starts, videos = index.clips(span, span if step is None else step, padding is not None)
+
+        # Shuffle the clips
+        rng = self._rng if seed is None else random.Random(seed)
+        order = list(range(len(starts)))
+        rng.shuffle(order)
+        nb_batches = len(order)//batch_size
+        if rest and len(order) > nb_batches*batch_size:
+            nb_batches += 1
+        for b in range(nb_batches):
+            clips = order[b*batch_size:(b+1)*batch_size]
+            yield self._read_clips(index, starts[clips], videos[clips], length, stride, padding)
+
+    def _read_clips(self, index, starts, videos, length, stride, padding):
+        "Reads and transforms the clips of length frames starting at the positions starts of index.video_samples, which are in the order of the frames, a single slice being read for each clip whose frames are contiguous in the file."
+        # Positions of the frames of each clip, the missing ones being replaced by the last frame of the video
+        positions = starts[:, np.newaxis] + stride*np.arange(length)
+        stops = index.video_indptr[videos + 1][:, np.newaxis]
+        missing = positions >= stops
+        positions = np.minimum(positions, stops - 1)
+        samples = index.video_samples[positions]
+        X = np.empty((len(starts), length) + self.input_dim, dtype=self.dtype)
+        for c in range(len(starts)):
+            first, last = samples[c, 0], samples[c, -1]
+            if last - first == positions[c, -1] - positions[c, 0]:
+                # Contiguous frames: one slice
+                X[c] = self._read_raw(slice(first, last + 1))[0][samples[c] - first]
+            else:
+                X[c] = self._read_raw(samples[c])[0]
+        X = self._transform_inputs(X.reshape((-1,) + self.input_dim)).reshape((len(starts), length) + self.input_dim)
+        if padding == 'zero':
+            X[missing] = 0
+        return X, self._transform_labels(index.video_label[videos].astype('int32'))
+
+def _partition(samples, rank, world_size, pad):
+    "Returns the part rank of the samples split into world_size contiguous parts of the same size, padding them with their first samples if pad is True, truncating them otherwise."
+    size = (len(samples) + world_size - 1)//world_size if pad else len(samples)//world_size
+    if size*world_size > len(samples):
+        samples = np.concatenate((samples, np.resize(samples, size*world_size - len(samples))))
+    return samples[rank*size:(rank+1)*size]
+
+class _BatchWriter(object):
+    "Gathers the samples sent by a _ShuffleBuffer into preallocated minibatches."
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        # Minibatch being filled and number of samples in it
+        self.batch = None
+        self.count = 0
+        # Complete minibatches not yielded yet
+        self.ready = []
+
+    def write(self, arrays, rows):
+        "Copies the given rows of the arrays (e.g. inputs and labels) at the end of the minibatches."
+        start = 0
+        while start < len(rows):
+            if self.batch is None:
+                self.batch = [np.empty((self.batch_size,) + a.shape[1:], dtype=a.dtype) for a in arrays]
+                self.count = 0
+            n = min(len(rows) - start, self.batch_size - self.count)
+            for batch, a in zip(self.batch, arrays):
+                np.take(a, rows[start:start+n], axis=0, out=batch[self.count:self.count+n], mode='clip')
+            self.count += n
+            start += n
+            if self.count == self.batch_size:
+                self.ready.append(tuple(self.batch))
+                self.batch = None
+
+    def rest(self):
+        "Returns the incomplete minibatch, or None."
+        if self.batch is None or self.count == 0:
+            return None
+        return tuple(batch[:self.count] for batch in self.batch)
+
+class _ShuffleBuffer(object):
+    "Shuffle buffer of _generate_blocks(): once it is full, each new sample replaces a random one, which is sent to the minibatches. Every sample is thus copied once into the buffer and once out of it."
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Preallocated arrays of capacity rows, the first size ones being used
+        self.arrays = None
+        self.size = 0
+
+    def push(self, arrays, rng, writer):
+        "Adds the samples of the arrays (e.g. inputs and labels), sending the replaced ones to the writer."
+        if self.arrays is None:
+            self.arrays = [np.empty((self.capacity,) + a.shape[1:], dtype=a.dtype) for a in arrays]
+        nb_samples = len(arrays[0])
+        start = min(nb_samples, self.capacity - self.size)
+        for buffer, a in zip(self.arrays, arrays):
+            buffer[self.size:self.size+start] = a[:start]
+        self.size += start
+        # The slots of a step are distinct, so that a new sample is not replaced in the same step
+        while start < nb_samples:
+            n = min(nb_samples - start, self.capacity)
+            slots = np.array(rng.sample(range(self.capacity), n), dtype='int64')
+            writer.write(self.arrays, slots)
+            for buffer, a in zip(self.arrays, arrays):
+                buffer[slots] = a[start:start+n]
+            start += n
+
+    def flush(self, rng, writer):
+        "Sends the samples left in the buffer in random order."
+        order = list(range(self.size))
+        rng.shuffle(order)
+        if self.arrays is not None:
+            writer.write(self.arrays, np.array(order, dtype='int64'))
+        self.size = 0
+
+# Database used by the worker processes of generate_batches()
+_worker_db = None
+
+def _init_worker(db):
+    "Initializes a worker process of generate_batches() with its own handle on the file."
+    global _worker_db
+    _worker_db = db
+    _worker_db._reopen()
+    # The events are sent back with the data, the hooks being called when they are recorded in the main process (with fork, the profiler is not pickled and keeps them)
+    if _worker_db.profiler is not None:
+        _worker_db.profiler._log = []
+        _worker_db.profiler.hooks = []
+
+def _read_task(task):
+    "Reads a (samples, block[, augment, seed]) task in a worker process, followed by the events of the profiler if any."
+    result = _worker_db._read_samples(task[0], task[1], None, *task[2:])
+    if _worker_db.profiler is not None:
+        return result + (_worker_db.profiler._flush(),)
+    return result
 
 
 
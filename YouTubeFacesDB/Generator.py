@@ -5,10 +5,13 @@ import re
 import os
 import random
 import csv
+from multiprocessing import Pool, cpu_count
 # Dependencies
 import numpy as np
 import h5py
 from PIL import Image
+# Local
+from .Statistics import RunningStatistics, _compute_statistics, _suffixes
 
 # Structure of the YFT directory
 original_folder = '/frame_images_DB/'
@@ -27,103 +30,473 @@ def _check_labels(labels, directory):
 			exit(0)
 
 
-def _gather_images_info(directory, labels, max_images_per_person):
-	"Iterates over all labels and gets the filenames and crop information"
-	data = []
-	for name in labels:
-		# Each image is described in frame_images_DB/Aaron_Eckhart.labeled_faces.txt
-		data_file = directory + original_folder + name + '.labeled_faces.txt'
-		# Read the file
-		data_person = []
+def _metadata_dtype(length):
+	"Structured type describing each frame, with filenames of at most length characters."
+	return np.dtype([
+		('label', 'int32'), # index of the label
+		('video', 'int32'), # index of the video
+		('frame', 'int32'), # index of the frame in the video
+		('filename', 'S'+str(max(1, length))), # path relative to frame_images_DB
+		('center', 'int32', (2,)), # center of the face
+		('size', 'int32', (2,)) # size of the face
+		])
+
+def _read_label_file(args):
+	"Reads frame_images_DB/<name>.labeled_faces.txt and returns the list of (filename, video, frame, center_w, center_h, size_w, size_h) for each frame, and False if the file could not be read entirely."
+	directory, name = args
+	# Each image is described in frame_images_DB/Aaron_Eckhart.labeled_faces.txt
+	data_file = directory + original_folder + name + '.labeled_faces.txt'
+	data_person = []
+	try:
+		with open(data_file, 'r') as csvfile:
+			for entry in csv.reader(csvfile, delimiter=','):
+				img_name = entry[0].replace('\\', '/')
+				video_idx = int(re.findall(r'/([\d]+)/', img_name)[0]) # index of the video
+				frame_idx = re.findall(r'\.([\d]+)\.\w+$', img_name) # frames are named <video>.<frame>.jpg
+				frame_idx = int(frame_idx[0]) if len(frame_idx) > 0 else len(data_person)
+				data_person.append((img_name, video_idx, frame_idx, int(entry[2]), int(entry[3]), int(entry[4]), int(entry[5])))
+	except Exception as e:
+		print('Error: could not read', data_file)
+		print(e)
+		return data_person, False
+	return data_person, True
+
+def _scan_index(directory, workers):
+	"Reads all label files (in parallel if workers > 1) and returns the list of labels, the offset of each label in the frames, the frames as a structured array and False if a label file could not be read entirely."
+	labels = _get_labels(directory)
+	jobs = [(directory, name) for name in labels]
+	if workers == 1:
+		results = [_read_label_file(job) for job in jobs]
+	else:
+		pool = Pool(workers)
+		try:
+			results = pool.map(_read_label_file, jobs)
+		finally:
+			pool.close()
+			pool.join()
+	data = [data_person for data_person, complete in results]
+	# Offsets of the frames of each label (label i has the frames offsets[i]:offsets[i+1])
+	offsets = np.zeros(len(labels) + 1, dtype='int64')
+	offsets[1:] = np.cumsum([len(data_person) for data_person in data])
+	# Compact structured array
+	length = max([len(entry[0]) for data_person in data for entry in data_person] + [1])
+	frames = np.empty(offsets[-1], dtype=_metadata_dtype(length))
+	for y, data_person in enumerate(data):
+		if len(data_person) == 0:
+			continue
+		rows = frames[offsets[y]:offsets[y+1]]
+		rows['label'] = y
+		rows['filename'] = [entry[0].encode('ascii', 'ignore') for entry in data_person]
+		values = np.array([entry[1:] for entry in data_person], dtype='int32')
+		rows['video'] = values[:, 0]
+		rows['frame'] = values[:, 1]
+		rows['center'] = values[:, 2:4]
+		rows['size'] = values[:, 4:6]
+	return labels, offsets, frames, all(complete for data_person, complete in results)
+
+def _load_index(directory, index_file, workers):
+	"Loads the metadata index of the YouTube Faces DB from index_file, or creates it if it does not exist, is outdated or can not be read. The index is only saved if all the label files could be read."
+	labels = _get_labels(directory)
+	if index_file is not None and os.path.isfile(index_file):
+		try:
+			with np.load(index_file) as data:
+				if [str(label) for label in data['labels']] == labels and data['frames'].dtype.names == _metadata_dtype(1).names:
+					return labels, data['offsets'], data['frames']
+			print('The index', index_file, 'is outdated.')
+		except Exception as e:
+			print('Warning: could not read the index', index_file, ':', e)
+	print('Scanning the label files...')
+	labels, offsets, frames, complete = _scan_index(directory, workers)
+	if index_file is not None and not complete:
+		print('Warning: the index is not saved in', index_file, 'as some label files could not be read.')
+	elif index_file is not None:
+		# Written in a temporary file then renamed, so that concurrent generations never read a partial index
+		tmp_file = index_file + '.' + str(os.getpid()) + '.tmp'
 		try:
-			with open(data_file, 'r') as csvfile:
-				for entry in csv.reader(csvfile, delimiter=','):
-					img_name = entry[0].replace('\\', '/')
-					center_w, center_h = int(entry[2]), int(entry[3])
-					size_w, size_h = int(entry[4]), int(entry[5])
-					data_person.append({
-						'name': name,
-						'filename': img_name,
-						'center': (center_w, center_h),
-						'size': (size_w, size_h)
-						})
+			with open(tmp_file, 'wb') as out:
+				np.savez(out, labels=np.array(labels), offsets=offsets, frames=frames)
+			os.rename(tmp_file, index_file)
+			print('Index saved in', index_file)
 		except Exception as e:
-			print('Error: could not read', data_file)
-			print(e)
-			return data
+			print('Warning: could not save the index in', index_file, ':', e)
+			if os.path.isfile(tmp_file):
+				os.remove(tmp_file)
+	return labels, offsets, frames
+
+def _subsample_videos(frames, frame_stride=1, max_frames_per_video=-1):
+	"Keeps one frame out of frame_stride in each video, then at most max_frames_per_video evenly spaced frames. The order of frames is preserved."
+	if len(frames) == 0 or (frame_stride == 1 and max_frames_per_video == -1):
+		return frames
+	# Position of each frame in its video
+	order = np.lexsort((frames['frame'], frames['video'], frames['label']))
+	label, video = frames['label'][order], frames['video'][order]
+	new_video = np.concatenate(([True], (label[1:] != label[:-1]) | (video[1:] != video[:-1])))
+	starts = np.flatnonzero(new_video)
+	run = np.cumsum(new_video) - 1 # index of the video
+	position = np.arange(len(order)) - starts[run]
+	keep = position % frame_stride == 0
+	# Evenly spaced frames among the remaining ones: the k-th is at position (k*n)//m
+	if max_frames_per_video != -1:
+		n = -(-np.diff(np.concatenate((starts, [len(order)])))//frame_stride) # frames per video after the stride
+		n, p, m = n[run], position//frame_stride, max_frames_per_video
+		k = -(-p*m//n)
+		keep &= (n <= m) | ((k < m) & ((k*n)//m == p))
+	mask = np.zeros(len(frames), dtype=bool)
+	mask[order[keep]] = True
+	return frames[mask]
+
+def _gather_images_info(directory, labels, max_images_per_person, index, frame_stride=1, max_frames_per_video=-1):
+	"Selects the frames of the labels in the index and returns them as a structured array whose label field is the position in labels."
+	all_labels, offsets, frames = index
+	positions = dict((name, y) for y, name in enumerate(all_labels))
+	data = []
+	for name in labels:
+		y = positions[name]
+		data_person = _subsample_videos(frames[offsets[y]:offsets[y+1]], frame_stride, max_frames_per_video)
 		# Possibly select a maximal number of them
 		if max_images_per_person == -1: # everything
-			data.extend(data_person)
+			data.append(data_person)
 		else:
-			data.extend(random.sample(data_person, max_images_per_person))
-
+			data.append(data_person[random.sample(range(len(data_person)), min(max_images_per_person, len(data_person)))])
+	data = np.concatenate(data) if len(data) > 0 else frames[:0].copy()
+	# Vectorized conversion of the index labels to the positions in labels
+	lut = np.full(len(all_labels), -1, dtype='int32')
+	lut[[positions[name] for name in labels]] = np.arange(len(labels))
+	data['label'] = lut[data['label']]
 	return data
 
-def _create_db(directory, metadata, labels, filename, size, color, rgb_first, bw_first, cropped):
-	"Main method to fetch all images into the hdf5 DB."
-	# Total number of images
-	nb_images = len(metadata)
-	# Final size of the image
+def _to_array(img, color, rgb_first, bw_first, dtype):
+	"Converts a resized image to the corresponding numpy array."
+	# Color
+	if not color:
+		img = img.convert('L')
+	# Get the numpy array
+	if dtype == 'uint8': # raw pixel values
+		img_data = np.array(img, dtype='uint8')
+	else:
+		img_data = np.array(img).astype('float32')/255.
+	# Swap the axes (to have (3, w, h))
+	if color and rgb_first:
+		img_data = img_data.swapaxes(0, 2)
+	# Add a dummy first axis to BW images for theano
+	if not color and bw_first:
+		img_data = img_data[np.newaxis, :, :]
+	return img_data
+
+def _load_image(directory, description, sizes, color, rgb_first, bw_first, cropped, dtype='float32', fast_decode=False, margin=0, profile=False):
+	"Opens an image, crops it to the face, resizes it to each of the sizes and returns the list of corresponding numpy arrays. With a margin, the region around the face is kept so that margin pixels are added on each side of the images. If profile is True, also returns the (stage, seconds, count, nbytes) events of the decoding and the resizing."
+	center_w, center_h = description['center'] # center of the face
+	size_w, size_h = description['size'] # size of the face
+	# Get the image
+	img_file_path = directory + original_folder + description['filename'].decode('ascii')
+	if profile:
+		tstart = time()
+	img = Image.open(img_file_path)
+	# Region of the face and of its margin, which depends on the size of the images
+	boxes = []
+	for size in sizes:
+		half_w, half_h = size_w/2.*(size[0] + 2*margin)/size[0], size_h/2.*(size[1] + 2*margin)/size[1]
+		boxes.append((center_w - half_w, center_h - half_h, center_w + half_w, center_h + half_h))
+	sizes = [(size[0] + 2*margin, size[1] + 2*margin) for size in sizes]
+	# Faces partially outside the frame are cropped at full resolution, as rounding their box to the pixels of a reduced image would shift them
+	width, height = img.size
+	inside = all(box[0] >= 0 and box[1] >= 0 and box[2] <= width and box[3] <= height for box in boxes)
+	# Fast path: the JPEG decoder downscales the image by 2, 4 or 8 while decoding when the face is much larger than the largest size
+	fast_decode = fast_decode and img.format == 'JPEG' and (inside or not cropped)
+	if fast_decode:
+		region_w, region_h = (size_w, size_h) if cropped else (width, height)
+		target_w, target_h = max(size[0] for size in sizes), max(size[1] for size in sizes)
+		img.draft('RGB' if color else 'L', (int(np.ceil(width*target_w/float(region_w))), int(np.ceil(height*target_h/float(region_h)))))
+		# Coordinates of the face in the reduced image
+		scale_w, scale_h = img.size[0]/float(width), img.size[1]/float(height)
+		boxes = [(scale_w*box[0], scale_h*box[1], scale_w*box[2], scale_h*box[3]) for box in boxes]
+	if profile:
+		# The image is otherwise decoded when it is first cropped or resized
+		img.load()
+		events = [('decode', time() - tstart, 1, os.path.getsize(img_file_path))]
+		tstart = time()
+	if fast_decode and cropped:
+		# Crop with sub-pixel precision and resize in one step
+		images = [img.resize(size, box=box) for size, box in zip(sizes, boxes)]
+	elif cropped and margin > 0:
+		# Crop the image to the face and its margin for each size, then resize it
+		images = [img.crop(box).resize(size) for size, box in zip(sizes, boxes)]
+	else:
+		# Crop the image to the face
+		if cropped:
+			img = img.crop(boxes[0])
+		# Resize the image
+		images = [img.resize(size) for size in sizes]
+	images = [_to_array(img, color, rgb_first, bw_first, dtype) for img in images]
+	if profile:
+		events.append(('resize', time() - tstart, 1, sum(img.nbytes for img in images)))
+		return images, events
+	return images
+
+def _load_image_star(args):
+	"Unpacks the arguments of _load_image, as Pool.imap only passes a single argument. Returns the error instead of the array if the image can not be read."
+	try:
+		return _load_image(*args)
+	except Exception as e:
+		return e
+
+def _load_images(directory, metadata, sizes, color, rgb_first, bw_first, cropped, dtype, fast_decode, workers, margin=0, profile=False):
+	"Yields the list of numpy arrays (one per size) of all images in the order of metadata (or the error if an image could not be read), possibly using a pool of processes. If profile is True, each list comes with the events of its loading."
+	jobs = ((directory, description, sizes, color, rgb_first, bw_first, cropped, dtype, fast_decode, margin, profile) for description in metadata)
+	if workers == 1:
+		for job in jobs:
+			yield _load_image_star(job)
+		return
+	# imap preserves the order of the jobs, the chunks only reduce the inter-process communication
+	chunksize = max(1, min(64, len(metadata)//(4*workers)))
+	pool = Pool(workers)
+	try:
+		for img_data in pool.imap(_load_image_star, jobs, chunksize):
+			yield img_data
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+def _resolutions(size, color, rgb_first, bw_first, margin=0):
+	"Returns the list of (suffix, size, final_size) of the image datasets: ('', size, final_size) for a single size, ('_32', (32, 32), final_size)... for a list of sizes. The final size includes the margin on each side."
+	if isinstance(size[0], int):
+		size = [size]
+		suffixes = ['']
+	else:
+		suffixes = ['_' + (str(s[0]) if s[0] == s[1] else str(s[0]) + 'x' + str(s[1])) for s in size]
+	return [(suffix, tuple(s), _final_size((s[0] + 2*margin, s[1] + 2*margin), color, rgb_first, bw_first)) for suffix, s in zip(suffixes, size)]
+
+def _final_size(size, color, rgb_first, bw_first):
+	"Shape of a single image in the HDF5 file."
 	if color and rgb_first:
 		final_size = (3, ) # channel is first
 	elif not color and bw_first: # add a dummy (1,) in front
 			final_size = (1, )
 	else:
 		final_size = ()			
-	final_size += size
+	final_size += tuple(size)
 	if color and not rgb_first:
 		final_size += (3,)
-	print('Final size of the images:', final_size)
-	# Initialize the hdf5 DB
-	f = h5py.File(filename, "w")
-	dset_X = f.create_dataset("X", (nb_images,) + final_size, dtype='f')
-	dset_Y = f.create_dataset("Y", (nb_images,), dtype='i')
-	dset_video = f.create_dataset("video", (nb_images,), dtype='i')
-	# Save the list of labels
+	return final_size
+
+def _chunk_shape(chunks, final_size, dtype):
+	"Converts the chunks argument of generate_ytf_database into a chunk shape for X (only the first dimension of a full chunk shape is used for a list of sizes)."
+	if chunks is None: # chunks of around 64kB, but at least one image
+		chunks = max(1, 2**16//(int(np.prod(final_size))*np.dtype(dtype).itemsize))
+	if chunks is True:
+		return chunks
+	if isinstance(chunks, int): # number of images per chunk
+		return (max(1, chunks),) + final_size
+	return tuple(chunks)
+
+def _save_labels(f, labels):
+	"Saves the list of labels in the HDF5 file, replacing the previous one."
+	if 'labels' in f:
+		del f['labels']
 	max_length = 0
 	for label in labels:
 		max_length = max(max_length, len(label))
 	asciiList = [n.encode("ascii", "ignore") for n in labels]
-	f.create_dataset('labels', (len(labels),1),'S'+str(max_length), labels)
-	# Compute the mean image
-	mean_img = np.zeros(final_size)
+	f.create_dataset('labels', (len(labels),1),'S'+str(max_length), asciiList)
+
+def _read_labels(f):
+	"Reads the list of labels from the HDF5 file."
+	return [label[0].decode('ascii') for label in f['labels']]
+
+def _save_metadata(f, metadata):
+	"Saves the list of images to process in the 'build' group of the HDF5 file, so that an interrupted generation can be resumed."
+	if 'build' in f:
+		del f['build']
+	grp = f.create_group('build')
+	for field in metadata.dtype.names:
+		grp.create_dataset(field, data=metadata[field])
+	# Progress of the generation
+	f.attrs['nb_processed'] = 0 # number of images of the build group already processed
+	f.attrs['nb_written'] = f['Y'].shape[0] # number of images in X
+	f.attrs['complete'] = False
+
+def _read_metadata(f):
+	"Reads the list of images to process from the 'build' group of the HDF5 file."
+	grp = f['build']
+	metadata = np.empty(grp['label'].shape[0], dtype=_metadata_dtype(grp['filename'].dtype.itemsize))
+	for field in metadata.dtype.names:
+		metadata[field] = grp[field][...]
+	return metadata
+
+def _init_db(filename, labels, resolutions, dtype, chunks, compression, shuffle, margin=0):
+	"Creates an empty HDF5 DB, whose datasets will grow during the generation."
+	f = h5py.File(filename, "w")
+	f.attrs['margin'] = margin # number of pixels around the faces
+	if isinstance(chunks, tuple) and len(resolutions) > 1:
+		chunks = chunks[0]
+	for suffix, size, final_size in resolutions:
+		f.create_dataset("X" + suffix, (0,) + final_size, maxshape=(None,) + final_size, dtype=dtype, 
+			chunks=_chunk_shape(chunks, final_size, dtype), compression=compression, shuffle=shuffle)
+	f.create_dataset("Y", (0,), maxshape=(None,), dtype='i', chunks=True)
+	f.create_dataset("video", (0,), maxshape=(None,), dtype='i', chunks=True)
+	_save_labels(f, labels)
+	return f
+
+def _check_db(f, resolutions, dtype):
+	"Checks that the images can be added to an existing HDF5 DB."
+	for suffix, size, final_size in resolutions:
+		if not 'X' + suffix in f:
+			print('Error:', f.filename, 'does not contain images of size', size)
+			return False
+		dset_X = f['X' + suffix]
+		if dset_X.shape[1:] != final_size or dset_X.dtype != np.dtype(dtype):
+			print('Error: the images of', f.filename, 'have the shape', dset_X.shape[1:], 'and type', dset_X.dtype, 
+				', not', final_size, 'and', dtype)
+			return False
+		if dset_X.maxshape[0] is not None:
+			print('Error:', f.filename, 'can not be extended. Generate it again with this version of generate_ytf_database.')
+			return False
+	return True
+
+def _create_db(directory, f, resolutions, color, rgb_first, bw_first, cropped, dtype='float32', fast_decode=False, workers=1, buffer_size=256, profiler=None):
+	"Main method to fetch all images of the 'build' group into the hdf5 DB, starting where the last generation stopped. The stages are timed if a profiler is given."
+	tstart = time()
+	dsets_X = [f['X' + suffix] for suffix, size, final_size in resolutions]
+	dset_Y, dset_video = f['Y'], f['video']
+	for dset_X in dsets_X:
+		print('Final size of the images:', dset_X.shape[1:])
+	# Progress of the generation: drop the images written after the last checkpoint
+	nb_processed = int(f.attrs['nb_processed'])
+	nb_written = int(f.attrs['nb_written'])
+	for dset in dsets_X + [dset_Y, dset_video]:
+		dset.resize(nb_written, axis=0)
+	# Images remaining to process
+	metadata = _read_metadata(f)[nb_processed:]
+	nb_images = len(metadata)
+	if nb_processed > 0:
+		print('Resuming after', nb_processed, 'images,', nb_images, 'remaining.')
+	# Flush whole chunks at once
+	if isinstance(dsets_X[0].chunks, tuple):
+		buffer_size = max(1, buffer_size//dsets_X[0].chunks[0])*dsets_X[0].chunks[0]
+	buffer_size = max(1, min(buffer_size, nb_images))
+	# Statistics of the images of each size, starting from the ones already in the file
+	stats = []
+	for suffix, size, final_size in resolutions:
+		if nb_written > 0 and 'class_mean' + suffix in f and f.attrs.get('nb_statistics' + suffix, -1) == nb_written:
+			stats.append(RunningStatistics.load(f, suffix))
+		elif nb_written > 0: # interrupted generation: the statistics are only saved at the end
+			print('Computing the statistics of the', nb_written, 'images already in the file...')
+			stats.append(_compute_statistics(f, nb_written, suffix=suffix))
+		else:
+			stats.append(RunningStatistics(final_size, f['labels'].shape[0]))
+		stats[-1].extend(f['labels'].shape[0])
+	scale = 1./255. if dtype == 'uint8' else 1. # the statistics are always in [0, 1]
+	# Buffers holding the images before they are written as a single slab
+	buffers_X = [np.empty((buffer_size,) + final_size, dtype=dtype) for suffix, size, final_size in resolutions]
+	buffer_Y = np.empty((buffer_size,), dtype='int32')
+	buffer_video = np.empty((buffer_size,), dtype='int32')
+	nb_buffer = 0 # number of images in the buffer
+	nb_skipped = 0
 	# Iterate over all images
-	for idx in range(nb_images):
+	sizes = [size for suffix, size, final_size in resolutions]
+	images = _load_images(directory, metadata, sizes, color, rgb_first, bw_first, cropped, dtype, fast_decode, workers, int(f.attrs.get('margin', 0)), profiler is not None)
+	nb_new = 0
+	for idx, img_data in enumerate(images):
 		# Retrieve the info
 		description= metadata[idx] # description
-		name = description['name'] # name of the person
-		y = labels.index(name) # corresponding index between 0 and 1594
-		filename = description['filename'] # complete filename
-		video_idx = int(re.findall(r'/([\d]+)/', filename)[0]) # index of the video
-		center_w, center_h = description['center'] # center of the face
-		size_w, size_h = description['size'] # size of the face
-		# Get the image
-		img_file_path = directory + original_folder + filename
-		img = Image.open(img_file_path)
-		# Crop the image to the face
-		if cropped:
-			img = img.crop((center_w - size_w/2, center_h - size_h/2, center_w + size_w/2, center_h + size_h/2))
-		# Resize the image
-		img = img.resize(size)
-		# Color
-		if not color:
-			img = img.convert('L')
-		# Get the numpy array
-		img_data = np.array(img).astype('float32')/255.
-		# Swap the axes (to have (3, w, h))
-		if color and rgb_first:
-			img_data = img_data.swapaxes(0, 2)
-		# Add a dummy first axis to BW images for theano
-		if not color and bw_first:
-			img_data = img_data[np.newaxis, :, :]
-		# Update the mean
-		mean_img += (img_data - mean_img)/float(idx+1)
-		# Push it to the HDF5 file
-		dset_X[idx, ...] = img_data
-		dset_Y[idx] = y
-		dset_video[idx] = video_idx
-	# Last, save the mean
-	f.create_dataset('mean', (1, )+final_size,'f', mean_img)
+		if profiler is not None and not isinstance(img_data, Exception):
+			img_data, events = img_data
+			for event in events:
+				profiler.record(*event)
+		if isinstance(img_data, Exception):
+			print('Warning: skipping', directory + original_folder + description['filename'].decode('ascii'), ':', img_data)
+			nb_skipped += 1
+		else:
+			y = description['label'] # index of the person
+			video_idx = description['video'] # index of the video
+			# Store it in the buffers
+			for buffer_X, data in zip(buffers_X, img_data):
+				buffer_X[nb_buffer, ...] = data
+			buffer_Y[nb_buffer] = y
+			buffer_video[nb_buffer] = video_idx
+			nb_buffer += 1
+		# Push the buffers to the HDF5 file when they are full and save the progress
+		if nb_buffer == buffer_size or idx + 1 == nb_images:
+			stop = nb_written + nb_buffer
+			if profiler is not None:
+				twrite = time()
+			for dset, buf in list(zip(dsets_X, buffers_X)) + [(dset_Y, buffer_Y), (dset_video, buffer_video)]:
+				dset.resize(stop, axis=0)
+				dset[nb_written:stop, ...] = buf[:nb_buffer]
+			if profiler is not None:
+				profiler.record('write', time() - twrite, nb_buffer, sum(buf[:nb_buffer].nbytes for buf in buffers_X + [buffer_Y, buffer_video]))
+				twrite = time()
+			for stat, buffer_X in zip(stats, buffers_X):
+				stat.update(scale*buffer_X[:nb_buffer], buffer_Y[:nb_buffer])
+			if profiler is not None:
+				profiler.record('statistics', time() - twrite, nb_buffer)
+			nb_new += nb_buffer
+			nb_written = stop
+			nb_buffer = 0
+			f.attrs['nb_written'] = nb_written
+			f.attrs['nb_processed'] = nb_processed + idx + 1
+			f.attrs['nb_skipped'] = int(f.attrs.get('nb_skipped', 0)) + nb_skipped
+			nb_skipped = 0
+			f.flush()
+	# Last, save the statistics (mean, std...) and the offsets of each label and video
+	for stat, (suffix, size, final_size) in zip(stats, resolutions):
+		stat.save(f, suffix)
+	_save_offsets(f)
+	# The list of images is only needed to resume the generation
+	del f['build']
+	f.attrs['complete'] = True
+	if f.attrs.get('nb_skipped', 0) > 0:
+		print(f.attrs['nb_skipped'], 'images could not be read and were skipped.')
+	f.close()
+	if profiler is not None:
+		profiler.record('total', time() - tstart, nb_new)
+
+def _save_offsets(f):
+	"Saves the CSR offsets of the frames of each label and of each video, when they are contiguous in the file."
+	Y, video = f['Y'][...], f['video'][...]
+	for name in ['label_offsets', 'video_offsets', 'video_label', 'video_index']:
+		if name in f:
+			del f[name]
+	# Labels: the frames of label i are label_offsets[i]:label_offsets[i+1]
+	if np.any(np.diff(Y) < 0):
+		return
+	f.create_dataset('label_offsets', data=np.searchsorted(Y, np.arange(f['labels'].shape[0] + 1)).astype('int64'))
+	# Videos: runs of frames with the same label and video index
+	starts = np.flatnonzero(np.concatenate(([len(Y) > 0], (Y[1:] != Y[:-1]) | (video[1:] != video[:-1]))))
+	keys = set(zip(Y[starts], video[starts]))
+	if len(keys) != len(starts): # a video is split in several runs
+		return
+	f.create_dataset('video_offsets', data=np.concatenate((starts, [len(Y)])).astype('int64'))
+	f.create_dataset('video_label', data=Y[starts])
+	f.create_dataset('video_index', data=video[starts])
+
+def _select_labels(directory, labels, exclude=[]):
+	"Returns the sorted list of labels to use, excluding the ones already present in the DB."
+	if labels==None or labels == -1:
+		print('Retrieving all labels...')
+		labels = [label for label in _get_labels(directory) if not label in exclude]
+	elif isinstance(labels, int):
+		print('Generating',  labels, 'labels randomly...')
+		nb_labels = labels
+		orig = [label for label in _get_labels(directory) if not label in exclude]
+		if nb_labels >= len(orig):
+			print('There are only', len(orig), 'labels in the database...')
+			labels = orig
+		else:
+			labels = sorted(random.sample(orig, nb_labels), key=lambda s: s.lower())
+			for label in labels:
+				print('\t', label)
+	else:
+		print('Checking the labels...')
+		_check_labels(labels, directory)
+		for label in labels:
+			if label in exclude:
+				print(label, 'is already in the database.')
+		labels = [label for label in labels if not label in exclude]
+	return labels
 
 def generate_ytf_database(
 	directory, 
@@ -132,10 +505,25 @@ def generate_ytf_database(
 	labels=None,
 	max_number=-1, 
 	max_images_per_person=-1, 
+	frame_stride=1,
+	max_frames_per_video=-1,
 	color=True, 
 	rgb_first=True, 
 	bw_first=False, 
-	cropped=True):
+	cropped=True,
+	dtype='float32',
+	fast_decode=False,
+	workers=1,
+	chunks=None,
+	compression=None,
+	shuffle=False,
+	resume=False,
+	append=False,
+	index_file='',
+	sort=False,
+	shard=None,
+	margin=0,
+	profiler=None):
 	"""
 	Method to generate a subset of the YouTube Faces database in a HDF5 file.
 
@@ -143,46 +531,182 @@ def generate_ytf_database(
 
 	* `directory`: director where the YouTube Face DB is located.
 	* `filename`: path and name of the hdf5 file where the DB will be saved.
-	* `size`: (width, height) size for the extracted images.
+	* `size`: (width, height) size for the extracted images, or list of sizes. With a list of sizes, each image is decoded and cropped once and then resized to each size: the images of size (32, 32) are stored in `X_32`, those of size (64, 48) in `X_64x48`, etc., each with its own statistics (`mean_32`...). `YouTubeFacesDB` selects the size when opening the file.
 	* `labels`: number or list of labels which should be used (default: None, for all labels).
 	* `max_number`: maximum number of images (default: -1, all of them).
 	* `max_images_per_person`: maximum number of images which should be extracted per person (default: -1, all images)
+	* `frame_stride`: only one frame out of `frame_stride` is used in each video (default: 1, all frames).
+	* `max_frames_per_video`: maximum number of evenly spaced frames extracted per video, after `frame_stride` is applied (default: -1, all frames). Consecutive frames being nearly identical, this prevents long videos from dominating the database. Both options are applied to the metadata before any image is read, and before `max_images_per_person`.
 	* `color`: if the color channels should be preserved (default: True) 
 	* `rgb_first`: if True, the numpy arrays of colored images will have the shape (3, w, h), otherwise (w, h, 3) (default: True). Useful for Theano backends.
 	* `bw_first`: if True, the numpy arrays of black&white images will have the shape (1, w, h), otherwise (w, h) (default: False). Useful for Theano backends.
 	* `cropped`: if the images should be cropped around the detected face (default: True)
+	* `dtype`: storage type of the images, in ['float32', 'uint8'] (default: 'float32'). 'float32' stores pixels in [0, 1], 'uint8' stores the raw pixel values in [0, 255] in a 4 times smaller file. `YouTubeFacesDB` converts them back to floats in [0, 1] when reading.
+	* `fast_decode`: if True, the JPEG frames are decoded directly at a reduced scale (1/2, 1/4 or 1/8) when the face is at least twice as large as `size`, which makes the decoding several times faster (default: False). The downscaling is then partially done in the DCT domain, so pixel values differ slightly from the exact path: on natural frames, the mean absolute difference stays below 1.5% of the pixel range (5% for a single pixel), but frames with a lot of high-frequency content (e.g. noise) can differ more for single pixels. Faces lying partially outside the frame are decoded at full scale, exactly as without `fast_decode`.
+	* `workers`: number of processes used to decode, crop and resize the images (default: 1, -1 for all cores). The images are written in the same order as with a single process.
+	* `chunks`: chunk layout of the `X` dataset in the HDF5 file: None (chunks of around 64kB), True (guessed by h5py), an integer (number of images per chunk) or a full chunk shape, only for a single size (default: None). Small chunks suit the random minibatches of `YouTubeFacesDB.generate_batches()`.
+	* `compression`: compression filter applied to `X`, in [None, 'gzip', 'lzf'] (default: None).
+	* `shuffle`: if the HDF5 byte-shuffle filter should be applied before compression (default: False).
+	* `resume`: if `filename` contains an interrupted generation, continues it where it stopped instead of starting again (default: False). The other arguments must be the same as for the interrupted call.
+	* `append`: adds the images of new labels to the existing file `filename` instead of overwriting it (default: False). `labels` then designates the labels to add; the ones already in the file are ignored. The images must have the same size and type as in the file.
+	* `index_file`: path to the metadata index of the YouTube Faces DB (default: 'ytf_index.npz' in `directory`, None to disable it). The label files of the DB are parsed once and saved in this file, so that the next generations load it instead.
+	* `sort`: if True, the images are sorted by label, video and frame before being read, so that the JPEG files are read and the HDF5 file is written sequentially (default: False, the images keep the order of the label files, or a random order when `max_number` is used). The attribute `sorted` of the file records it (it stays False when images are appended without sorting), and `YouTubeFacesDB.generate_clips()` requires it.
+	* `shard`: tuple (index, nb_shards) to only generate the shard number index (starting at 0) out of nb_shards (default: None, all images). The selected labels are split into nb_shards contiguous ranges and only the images of the corresponding range are written, the labels of the file being the complete list. Each shard can be generated by a different process or machine in its own file, and `merge_shards()` then combines them. `labels` must designate the same list in all shards (use a list, None or the same random seed), and `max_number` applies to each shard.
+	* `margin`: number of pixels of the region around the face kept on each side of the cropped images (default: 0). The images of size (32, 32) with `margin=4` have the size (40, 40), the face occupying the central (32, 32) pixels, and the margin is saved in the attribute `margin` of the file. The random crops and shifts of `YouTubeFacesDB.generate_batches()` (see `RandomCrop`) then translate the faces with real pixels instead of zeros.
+	* `profiler`: `Profiler` recording the duration of the decoding, resizing, writing and statistics of the images, e.g. to find which stage limits the generation (default: None, no measurement). Call its `report()` method at the end.
+
+	The progress is saved in the HDF5 file after each slab of images, and images which can not be read are skipped with a warning. Besides the images, the file contains statistics computed on the fly (in [0, 1]): the mean image `mean`, the standard deviation of each pixel `std`, the mean and standard deviation of each color channel `channel_mean` and `channel_std`, the mean image of each class `class_mean` and the number of images per class `class_count`. When the frames of each label (resp. video) are contiguous in the file, which is always the case with `sort=True`, their positions are saved in `label_offsets` (resp. `video_offsets`, with the label and video index of each video in `video_label` and `video_index`).
 	"""
 	tstart = time()
+	# Number of processes
+	if workers == -1:
+		workers = cpu_count()
+	# Storage type
+	if not dtype in ['float32', 'uint8']:
+		print("Error: dtype must be in ['float32', 'uint8']")
+		dtype = 'float32'
+	# Compression filter
+	if not compression in [None, 'gzip', 'lzf']:
+		print("Error: compression must be in [None, 'gzip', 'lzf']")
+		compression = None
+	resolutions = _resolutions(size, color, rgb_first, bw_first, margin if cropped else 0)
+	# Metadata index
+	if index_file == '':
+		index_file = directory + '/ytf_index.npz'
+
+	# Resume an interrupted generation
+	if resume and os.path.isfile(filename):
+		f = h5py.File(filename, "r+")
+		if f.attrs.get('complete', True):
+			print(filename, 'is already complete.')
+			f.close()
+			return
+		if not _check_db(f, resolutions, dtype):
+			f.close()
+			return
+		print('Resuming the generation of', filename)
+		_create_db(directory, f, resolutions, color, rgb_first, bw_first, cropped, dtype, fast_decode, workers, profiler=profiler)
+		print('Done in', time()-tstart, 'seconds.')
+		return
+
 	# Get the labels
-	if labels==None or labels == -1:
-		print('Retrieving all labels...')
-		labels = _get_labels(directory)
-	elif isinstance(labels, int):
-		print('Generating',  labels, 'labels randomly...')
-		nb_labels = labels
-		orig = _get_labels(directory)
-		if nb_labels >= len(orig):
-			print('There are only', len(orig), 'labels in the database...')
-			labels = orig
-		else:
-			labels = sorted(random.sample(orig, nb_labels), key=lambda s: s.lower())
-			for label in labels:
-				print('\t', label)
+	if append:
+		if not os.path.isfile(filename):
+			print('Error: can not append to', filename, 'as it does not exist.')
+			return
+		f = h5py.File(filename, "r+")
+		if not _check_db(f, resolutions, dtype):
+			f.close()
+			return
+		existing_labels = _read_labels(f)
+		labels = _select_labels(directory, labels, existing_labels)
+		if len(labels) == 0:
+			print('No new label to add to', filename)
+			f.close()
+			return
 	else:
-		print('Checking the labels...')
-		_check_labels(labels, directory)
+		labels = _select_labels(directory, labels)
+	all_labels = labels
+
+	# Only keep a contiguous range of labels in a shard, all labels being saved in the file
+	first_label = 0
+	if shard is not None:
+		if append:
+			print('Error: shards can not be appended to an existing file.')
+			f.close()
+			return
+		shard_index, nb_shards = shard
+		first_label = len(all_labels)*shard_index//nb_shards
+		labels = all_labels[first_label:len(all_labels)*(shard_index+1)//nb_shards]
+		print('Shard', shard_index, 'of', nb_shards, 'contains', len(labels), 'labels.')
 
 	# Retrieve the metadata on all images
 	print('Gathering image locations...')
-	metadata = _gather_images_info(directory, labels, max_images_per_person)
+	index = _load_index(directory, index_file, workers)
+	metadata = _gather_images_info(directory, labels, max_images_per_person, index, frame_stride, max_frames_per_video)
 	nb_images = len(metadata)
 	print('Found', nb_images, 'images for', len(labels), 'people.')
 
 	# Reduce the number of images
 	if max_number != -1 and max_number < nb_images:
 		print('Reducing this number to', max_number)
-		metadata = random.sample(metadata, max_number)
+		metadata = metadata[random.sample(range(nb_images), max_number)]
+
+	# Sort the images by label, video and frame
+	if sort:
+		metadata = metadata[np.lexsort((metadata['frame'], metadata['video'], metadata['label']))]
+
+	# Initialize the hdf5 DB, or extend the labels of the existing one
+	if append:
+		metadata['label'] += len(existing_labels)
+		labels = existing_labels + labels
+		_save_labels(f, labels)
+	else:
+		metadata['label'] += first_label
+		f = _init_db(filename, all_labels, resolutions, dtype, chunks, compression, shuffle, margin if cropped else 0)
+	# The frames of each video are in order only if all the images were sorted
+	f.attrs['sorted'] = bool(sort and f.attrs.get('sorted', not append))
+	_save_metadata(f, metadata)
 
 	# Get all the images, crop/resize them, and save them into a hdf5 file
-	_create_db(directory, metadata, labels, filename, size, color, rgb_first, bw_first, cropped)
+	_create_db(directory, f, resolutions, color, rgb_first, bw_first, cropped, dtype, fast_decode, workers, profiler=profiler)
+	print('Done in', time()-tstart, 'seconds.')
+
+def merge_shards(filenames, filename):
+	"""
+	Combines HDF5 files generated separately (e.g. with the `shard` argument of `generate_ytf_database`) into a single master file readable by `YouTubeFacesDB`.
+
+	`X`, `Y` and `video` are HDF5 virtual datasets pointing to the data of the shards, so no image is copied: the shards must stay at the same location relative to the master file. The statistics (mean, std...) are combined from the ones of each shard, weighted by their number of images.
+
+	Arguments:
+
+	* `filenames`: list of the HDF5 files to combine, in the desired order. They must have the same list of labels and images of the same shape and type.
+	* `filename`: path and name of the master HDF5 file.
+	"""
+	tstart = time()
+	shards = [h5py.File(shard, "r") for shard in filenames]
+	# Check the shards
+	labels = _read_labels(shards[0])
+	suffixes = _suffixes(shards[0])
+	for shard in shards:
+		if not shard.attrs.get('complete', True):
+			print('Error: the generation of', shard.filename, 'is not complete.')
+			for shard in shards:
+				shard.close()
+			return
+		if _read_labels(shard) != labels or _suffixes(shard) != suffixes or shard.attrs.get('margin', 0) != shards[0].attrs.get('margin', 0) or any(shard['X' + suffix].shape[1:] != shards[0]['X' + suffix].shape[1:] or shard['X' + suffix].dtype != shards[0]['X' + suffix].dtype for suffix in suffixes):
+			print('Error:', shard.filename, 'does not have the same labels or image shape as', shards[0].filename)
+			for shard in shards:
+				shard.close()
+			return
+	nb_images = sum(shard['Y'].shape[0] for shard in shards)
+	print('Merging', len(shards), 'shards with', nb_images, 'images.')
+	# Virtual datasets, whose sources are relative to the master file
+	f = h5py.File(filename, "w")
+	directory = os.path.dirname(os.path.abspath(filename))
+	for name in ['X' + suffix for suffix in suffixes] + ['Y', 'video']:
+		layout = h5py.VirtualLayout(shape=(nb_images,) + shards[0][name].shape[1:], dtype=shards[0][name].dtype)
+		start = 0
+		for shard in shards:
+			stop = start + shard[name].shape[0]
+			path = os.path.relpath(os.path.abspath(shard.filename), directory)
+			layout[start:stop, ...] = h5py.VirtualSource(path, name, shape=shard[name].shape)
+			start = stop
+		f.create_virtual_dataset(name, layout)
+	_save_labels(f, labels)
+	f.attrs['margin'] = shards[0].attrs.get('margin', 0)
+	f.attrs['sorted'] = all(bool(shard.attrs.get('sorted', False)) for shard in shards)
+	# Statistics of all shards
+	for suffix in suffixes:
+		stats = RunningStatistics(shards[0]['X' + suffix].shape[1:], len(labels))
+		for shard in shards:
+			if 'class_mean' + suffix in shard and shard.attrs.get('nb_statistics' + suffix, -1) == shard['Y'].shape[0]:
+				stats.merge(RunningStatistics.load(shard, suffix))
+			else:
+				stats.merge(_compute_statistics(shard, suffix=suffix))
+		stats.save(f, suffix)
+	for shard in shards:
+		shard.close()
+	_save_offsets(f)
+	f.close()
 	print('Done in', time()-tstart, 'seconds.')
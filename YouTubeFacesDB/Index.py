@@ -0,0 +1,236 @@
+# Standard library
+from __future__ import print_function, with_statement
+# Dependencies
+import numpy as np
+
+
+def _csr(keys, nb_keys):
+    "Returns the (indptr, order) CSR representation of the integer keys: the positions of key k are order[indptr[k]:indptr[k+1]], in increasing order."
+    order = np.argsort(keys, kind='mergesort')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=nb_keys)))).astype('int64')
+    return indptr, order
+
+class SampleIndex(object):
+    """
+    Compressed (CSR) index of the samples of each label and of each video, allowing to access or draw them without scanning `Y`.
+
+    The samples of label `i` are `label_samples[label_indptr[i]:label_indptr[i+1]]`, those of video `v` are `video_samples[video_indptr[v]:video_indptr[v+1]]`, both in increasing order. The videos are numbered in the order of their label, then of their index for this label (`video_label` and `video_index`).
+    """
+    def __init__(self, labels, videos, nb_classes, nb_videos, samples=None):
+        """
+        Parameters:
+
+        * `labels`: label of each sample.
+        * `videos`: number of the video of each sample, between 0 and nb_videos.
+        * `nb_classes`: number of labels.
+        * `nb_videos`: number of videos.
+        * `samples`: indices of the samples in the file, if the index only covers part of it (default: None, all the samples).
+        """
+        self.labels = np.asarray(labels, dtype='int64')
+        self.videos = np.asarray(videos, dtype='int64')
+        self.samples = np.arange(len(self.labels)) if samples is None else np.asarray(samples, dtype='int64')
+        self.nb_classes = nb_classes
+        self.nb_videos = nb_videos
+        self.label_indptr, order = _csr(self.labels, nb_classes)
+        self.label_samples = self.samples[order]
+        self.video_indptr, order = _csr(self.videos, nb_videos)
+        self.video_samples = self.samples[order]
+        # Label and index of each video
+        first = self.video_samples[self.video_indptr[:-1][np.diff(self.video_indptr) > 0]]
+        self.video_label = np.zeros(nb_videos, dtype='int64')
+        self.video_label[np.diff(self.video_indptr) > 0] = self.labels[np.searchsorted(self.samples, first)]
+        self.video_index = np.zeros(nb_videos, dtype='int64')
+        # Arrays used to draw pairs, computed on first use
+        self._pairs = {}
+
+    @classmethod
+    def from_arrays(cls, y, video, nb_classes):
+        "Builds the index from the label and the video index (for its label) of each sample."
+        y = np.asarray(y, dtype='int64').ravel()
+        video = np.asarray(video, dtype='int64').ravel()
+        # Number the (label, video) pairs in lexicographic order
+        pairs, videos = np.unique(y*(int(video.max(initial=0)) + 1) + video, return_inverse=True)
+        index = cls(y, videos.ravel(), nb_classes, len(pairs))
+        index.video_index = video[index.video_samples[index.video_indptr[:-1]]] if len(pairs) else np.zeros(0, dtype='int64')
+        return index
+
+    @classmethod
+    def from_offsets(cls, label_offsets, video_offsets, video_index):
+        "Builds the index of a sorted file from its offsets, without reading the labels."
+        nb_classes = len(label_offsets) - 1
+        nb_videos = len(video_offsets) - 1
+        labels = np.repeat(np.arange(nb_classes), np.diff(label_offsets))
+        videos = np.repeat(np.arange(nb_videos), np.diff(video_offsets))
+        index = cls(labels, videos, nb_classes, nb_videos)
+        index.video_index = np.asarray(video_index, dtype='int64')
+        return index
+
+    def restrict(self, samples):
+        "Returns the index of a subset of the samples, given by their increasing indices in the file."
+        samples = np.asarray(samples, dtype='int64')
+        positions = np.searchsorted(self.samples, samples)
+        index = SampleIndex(self.labels[positions], self.videos[positions], self.nb_classes, self.nb_videos, samples)
+        index.video_label = self.video_label
+        index.video_index = self.video_index
+        return index
+
+    def label(self, i):
+        "Returns the samples of label i."
+        return self.label_samples[self.label_indptr[i]:self.label_indptr[i+1]]
+
+    def video(self, v):
+        "Returns the samples of video v."
+        return self.video_samples[self.video_indptr[v]:self.video_indptr[v+1]]
+
+    def find_video(self, label, video):
+        "Returns the number of the video of index video for the label, or None if it does not exist."
+        v = np.flatnonzero((self.video_label == label) & (self.video_index == video))
+        return int(v[0]) if len(v) else None
+
+    def balanced(self, nb_samples, rng):
+        """
+        Draws samples whose labels are uniformly distributed: each sample has a random label among the ones present in the index, then a random sample of this label.
+
+        Parameters:
+
+        * `nb_samples`: number of samples.
+        * `rng`: `np.random.RandomState` instance.
+        """
+        counts = np.diff(self.label_indptr)
+        present = np.flatnonzero(counts)
+        labels = present[rng.randint(0, len(present), nb_samples)]
+        positions = self.label_indptr[labels] + (rng.random_sample(nb_samples)*counts[labels]).astype('int64')
+        return self.label_samples[positions]
+
+    def cap_videos(self, max_per_video, rng):
+        """
+        Returns the increasing indices of at most max_per_video random samples of each video.
+
+        Parameters:
+
+        * `max_per_video`: maximal number of samples per video.
+        * `rng`: `np.random.RandomState` instance.
+        """
+        # Random order inside each video
+        order = np.lexsort((rng.random_sample(len(self.samples)), self.videos))
+        rank = np.arange(len(order)) - self.video_indptr[self.videos[order]]
+        return np.sort(self.samples[order[rank < max_per_video]])
+
+    def stratified_split(self, validation_size, test_size, rng, by_video=False):
+        """
+        Splits the samples into (training, validation, test) increasing indices, with the same proportions for each label.
+
+        Parameters:
+
+        * `validation_size`: proportion of the samples of each label in the validation set.
+        * `test_size`: proportion of the samples of each label in the test set.
+        * `rng`: `np.random.RandomState` instance.
+        * `by_video`: if True, all the samples of a video are in the same set, the proportions being then approximate.
+        """
+        if by_video:
+            sizes = np.diff(self.video_indptr)
+            units = np.flatnonzero(sizes)
+            labels = self.video_label[units]
+            sizes = sizes[units]
+        else:
+            units = np.arange(len(self.samples))
+            labels = self.labels
+            sizes = np.ones(len(units), dtype='int64')
+        # Units in random order inside each label, and number of samples of the label before them
+        order = np.lexsort((rng.random_sample(len(units)), labels))
+        units, labels, sizes = units[order], labels[order], sizes[order]
+        before = np.cumsum(sizes) - sizes
+        starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1]))) if len(labels) else np.zeros(0, dtype='int64')
+        before -= np.repeat(before[starts], np.diff(np.concatenate((starts, [len(labels)]))))
+        counts = np.diff(self.label_indptr)[labels]
+        if by_video:
+            # A video goes to the set of its middle frame
+            position = before + sizes/2.
+            nb_val, nb_test = counts*validation_size, counts*test_size
+        else:
+            position = before
+            nb_val, nb_test = (counts*validation_size).astype('int64'), (counts*test_size).astype('int64')
+        parts = np.where(position < nb_val, 1, np.where(position < nb_val + nb_test, 2, 0))
+        # Set of each sample
+        if by_video:
+            video_parts = np.zeros(self.nb_videos, dtype='int64')
+            video_parts[units] = parts
+            sample_parts = video_parts[self.videos]
+        else:
+            sample_parts = np.zeros(len(self.samples), dtype='int64')
+            sample_parts[units] = parts
+        return tuple(self.samples[sample_parts == part] for part in range(3))
+
+    def _pair_arrays(self, exclude_same_video):
+        "Returns the label of each position of video_samples, the range of positions which can not be its positive (itself or its video), and the positions which can be anchors."
+        if not exclude_same_video in self._pairs:
+            video = np.repeat(np.arange(self.nb_videos), np.diff(self.video_indptr))
+            label = self.video_label[video]
+            if exclude_same_video:
+                start, stop = self.video_indptr[video], self.video_indptr[video+1]
+            else:
+                start = np.arange(len(video))
+                stop = start + 1
+            anchors = np.flatnonzero(np.diff(self.label_indptr)[label] > stop - start)
+            self._pairs[exclude_same_video] = (label, start, stop, anchors)
+        return self._pairs[exclude_same_video]
+
+    def can_draw_triplets(self, exclude_same_video=False):
+        "Returns True if triplets can be drawn: at least one sample has a positive, and there are several labels."
+        return len(self._pair_arrays(exclude_same_video)[3]) > 0 and np.count_nonzero(np.diff(self.label_indptr)) > 1
+
+    def triplets(self, nb_triplets, rng, exclude_same_video=False):
+        """
+        Draws random (anchor, positive, negative) triplets of samples, the positive having the same label as the anchor and the negative a different one. Returns three arrays of sample indices.
+
+        Parameters:
+
+        * `nb_triplets`: number of triplets.
+        * `rng`: `np.random.RandomState` instance.
+        * `exclude_same_video`: if True, the positive is taken from another video than the anchor.
+
+        The samples are drawn with a constant number of vectorized operations, using the fact that the samples of a label, and inside them those of a video, are contiguous in `video_samples`.
+        """
+        label, start, stop, anchors = self._pair_arrays(exclude_same_video)
+        counts = np.diff(self.label_indptr)
+        anchor = anchors[rng.randint(0, len(anchors), nb_triplets)]
+        l = label[anchor]
+        # Positive: a position of the label, skipping the excluded range
+        excluded = stop[anchor] - start[anchor]
+        positive = self.label_indptr[l] + (rng.random_sample(nb_triplets)*(counts[l] - excluded)).astype('int64')
+        positive = np.where(positive >= start[anchor], positive + excluded, positive)
+        # Negative: any position, skipping the label
+        negative = (rng.random_sample(nb_triplets)*(len(self.video_samples) - counts[l])).astype('int64')
+        negative = np.where(negative >= self.label_indptr[l], negative + counts[l], negative)
+        return self.video_samples[anchor], self.video_samples[positive], self.video_samples[negative]
+
+    def pairs(self, nb_pairs, rng, exclude_same_video=False):
+        """
+        Draws random pairs of samples, half of them with the same label (see `triplets()`). Returns two arrays of sample indices and an array which is 1 for the pairs with the same label, 0 otherwise.
+
+        Parameters:
+
+        * `nb_pairs`: number of pairs.
+        * `rng`: `np.random.RandomState` instance.
+        * `exclude_same_video`: if True, the pairs with the same label come from different videos.
+        """
+        anchor, positive, negative = self.triplets(nb_pairs, rng, exclude_same_video)
+        same = (rng.permutation(nb_pairs) < (nb_pairs + 1)//2).astype('int32')
+        return anchor, np.where(same, positive, negative), same
+
+    def clips(self, span, step=1, pad=False):
+        """
+        Returns the first position in `video_samples` and the video of every clip of span consecutive frames, the clips of a video starting every step frames. The samples of each video must be in the order of its frames, i.e. the file sorted with the `sort` argument of `generate_ytf_database`.
+
+        Parameters:
+
+        * `span`: number of frames covered by a clip.
+        * `step`: number of frames between the starts of two clips of a video (default: 1).
+        * `pad`: if True, the videos shorter than span give a single clip starting at their first frame. Otherwise they are ignored (default: False).
+        """
+        sizes = np.diff(self.video_indptr)
+        nb_clips = np.where(sizes >= span, (sizes - span)//step + 1, 1 if pad else 0)
+        nb_clips[sizes == 0] = 0
+        video = np.repeat(np.arange(self.nb_videos), nb_clips)
+        rank = np.arange(len(video)) - np.repeat(np.cumsum(nb_clips) - nb_clips, nb_clips)
+        return self.video_indptr[video] + rank*step, video
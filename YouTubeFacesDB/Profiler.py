@@ -0,0 +1,122 @@
+# Standard library
+from __future__ import print_function, with_statement
+import math
+# Dependencies
+import numpy as np
+
+
+class Profiler(object):
+    """
+    Counters and timers of the stages of the generation of a database and of the loading of minibatches.
+
+    A `Profiler` is passed to `generate_ytf_database` or `YouTubeFacesDB` with their `profiler` argument, which is None by default: the stages are then not timed at all. Each event of a stage (e.g. the decoding of an image, the reading of a minibatch) is recorded with its duration, its number of items (images or samples) and its number of bytes. The stages are:
+
+    * generation: `decode` (reading and decoding of a JPEG frame, with its file size), `resize` (cropping and resizing to all the sizes), `write` (writing of a slab of images to the HDF5 file), `statistics` (update of the mean, std...) and `total` (whole generation).
+    * loading: `read` (reading of the samples from the file or the cache), `transform` (conversion, mean removal, labels), `augment`, `wait` (time during which the caller of `generate_batches()` waited for a minibatch) and the counters `cache_hit` and `cache_miss` (number of samples read from memory and from the file).
+
+    The events of the worker processes are sent back with the data and recorded in the main process. Hooks are called with `(stage, seconds, count, nbytes)` for every event, `seconds` being None for the counters.
+    """
+    #: Number of bins of the latency histograms: bin k counts the events lasting between 2**(k-1) and 2**k microseconds
+    nb_bins = 32
+
+    def __init__(self, hooks=None):
+        """
+        Parameters:
+
+        * `hooks`: list of callables called with `(stage, seconds, count, nbytes)` for every event (default: None).
+        """
+        self.hooks = list(hooks) if hooks is not None else []
+        self.reset()
+        # Events kept to be sent back by a worker process, None in the main process
+        self._log = None
+
+    def reset(self):
+        "Forgets all the events."
+        #: Statistics of each stage: {stage: {'calls', 'count', 'seconds', 'bytes', 'histogram'}}
+        self.stages = {}
+
+    def add_hook(self, hook):
+        "Adds a callable called with `(stage, seconds, count, nbytes)` for every event."
+        self.hooks.append(hook)
+
+    def record(self, stage, seconds, count=1, nbytes=0):
+        """
+        Records an event.
+
+        Parameters:
+
+        * `stage`: name of the stage.
+        * `seconds`: duration of the event, or None for a counter.
+        * `count`: number of images or samples processed (default: 1).
+        * `nbytes`: number of bytes read or written (default: 0).
+        """
+        if not stage in self.stages:
+            self.stages[stage] = {'calls': 0, 'count': 0, 'seconds': 0., 'bytes': 0, 'histogram': np.zeros(self.nb_bins, dtype='int64')}
+        stats = self.stages[stage]
+        stats['calls'] += 1
+        stats['count'] += int(count)
+        stats['bytes'] += int(nbytes)
+        if seconds is not None:
+            stats['seconds'] += seconds
+            stats['histogram'][min(self.nb_bins - 1, max(0, int(math.ceil(math.log(max(seconds*1e6, 1.), 2)))))] += 1
+        if self._log is not None:
+            self._log.append((stage, seconds, count, nbytes))
+        for hook in self.hooks:
+            hook(stage, seconds, count, nbytes)
+
+    def _flush(self):
+        "Returns and forgets the events kept by a worker process."
+        events, self._log = self._log, []
+        return events
+
+    def __getstate__(self):
+        "The hooks are only called in the main process."
+        state = self.__dict__.copy()
+        state['hooks'] = []
+        return state
+
+    def _percentile(self, histogram, q):
+        "Upper bound in seconds of the q-th percentile of the durations of a histogram."
+        if histogram.sum() == 0:
+            return 0.
+        k = int(np.searchsorted(np.cumsum(histogram), q/100.*histogram.sum()))
+        return 2.**k*1e-6
+
+    def summary(self):
+        """
+        Returns a dictionary with the statistics of each stage:
+
+        * `calls`, `count`, `seconds`, `bytes`: number of events, of items and of bytes, and total duration.
+        * `rate`, `throughput`: items and bytes per second.
+        * `mean_ms`, `p50_ms`, `p99_ms`: mean duration of an event, and upper bounds of the median and of the 99th percentile (from the histogram).
+        * `cache_hit_rate`: proportion of the samples read from memory, if the cache counters were recorded.
+        """
+        summary = {}
+        for stage, stats in self.stages.items():
+            seconds = stats['seconds']
+            summary[stage] = {
+                'calls': stats['calls'],
+                'count': stats['count'],
+                'seconds': seconds,
+                'bytes': stats['bytes'],
+                'rate': stats['count']/seconds if seconds > 0 else 0.,
+                'throughput': stats['bytes']/seconds if seconds > 0 else 0.,
+                'mean_ms': 1e3*seconds/stats['calls'],
+                'p50_ms': 1e3*self._percentile(stats['histogram'], 50),
+                'p99_ms': 1e3*self._percentile(stats['histogram'], 99),
+            }
+        if 'cache_hit' in self.stages or 'cache_miss' in self.stages:
+            hits = self.stages.get('cache_hit', {'count': 0})['count']
+            misses = self.stages.get('cache_miss', {'count': 0})['count']
+            summary['cache_hit_rate'] = hits/float(max(1, hits + misses))
+        return summary
+
+    def report(self):
+        "Prints the statistics of each stage, in decreasing order of total duration."
+        summary = self.summary()
+        print('%-12s %8s %10s %10s %10s %12s %10s %10s' % ('stage', 'calls', 'items', 'seconds', 'items/s', 'MB/s', 'p50 ms', 'p99 ms'))
+        for stage in sorted(self.stages, key=lambda stage: -summary[stage]['seconds']):
+            stats = summary[stage]
+            print('%-12s %8d %10d %10.3f %10.1f %12.2f %10.3f %10.3f' % (stage, stats['calls'], stats['count'], stats['seconds'], stats['rate'], stats['throughput']/1e6, stats['p50_ms'], stats['p99_ms']))
+        if 'cache_hit_rate' in summary:
+            print('Cache hit rate:', summary['cache_hit_rate'])
@@ -0,0 +1,188 @@
+# Standard library
+from __future__ import print_function, with_statement
+from time import time
+# Dependencies
+import numpy as np
+import h5py
+
+
+def _suffixes(f):
+    "Returns the suffixes of the image datasets of a file: [''] for X, ['_32', '_64'] for X_32 and X_64..."
+    return sorted(name[1:] for name in f if name == 'X' or name.startswith('X_'))
+
+def _channel_axis(shape):
+    "Returns the axis of the color channels in the shape of an image, or None for images without channel axis."
+    if len(shape) == 3 and shape[0] in [1, 3]: # (3, w, h) or (1, w, h)
+        return 0
+    if len(shape) == 3 and shape[2] == 3: # (w, h, 3)
+        return 2
+    return None
+
+class RunningStatistics(object):
+    """
+    Streaming statistics of the images (mean, standard deviation, per-channel and per-class means), updated with slabs of images.
+
+    Each slab is reduced with vectorized operations and merged into the running statistics with the parallel variant of Welford's algorithm (Chan et al.), so the result does not depend on the slab size.
+    """
+    def __init__(self, shape, nb_classes):
+        """
+        Parameters:
+
+        * `shape`: shape of a single image.
+        * `nb_classes`: number of labels.
+        """
+        self.shape = tuple(shape)
+        #: Number of images seen so far
+        self.count = 0
+        #: Mean image
+        self.mean = np.zeros(self.shape)
+        # Sum of the squared differences to the mean
+        self._m2 = np.zeros(self.shape)
+        #: Number of images of each class
+        self.class_count = np.zeros(nb_classes, dtype='int64')
+        self._class_sum = np.zeros((nb_classes,) + self.shape)
+
+    @property
+    def nb_classes(self):
+        "Number of classes."
+        return self.class_count.shape[0]
+
+    def extend(self, nb_classes):
+        "Adds new classes to the statistics."
+        if nb_classes <= self.nb_classes:
+            return
+        self.class_count = np.concatenate((self.class_count, np.zeros(nb_classes - self.nb_classes, dtype='int64')))
+        self._class_sum = np.concatenate((self._class_sum, np.zeros((nb_classes - self._class_sum.shape[0],) + self.shape)))
+
+    def update(self, X, y):
+        """
+        Merges a slab of images into the statistics.
+
+        Parameters:
+
+        * `X`: array of images with values in [0, 1], the first axis being the image number.
+        * `y`: array of the corresponding labels.
+        """
+        n = X.shape[0]
+        if n == 0:
+            return
+        X = np.asarray(X, dtype='float64')
+        y = np.asarray(y)
+        # Statistics of the slab
+        slab_mean = X.mean(axis=0)
+        slab_m2 = ((X - slab_mean)**2).sum(axis=0)
+        # Merge
+        total = self.count + n
+        delta = slab_mean - self.mean
+        self.mean += delta*(n/float(total))
+        self._m2 += slab_m2 + delta**2*(self.count*n/float(total))
+        self.count = total
+        # Per-class sums: the slab is sorted by label and each run is summed at once
+        order = np.argsort(y, kind='mergesort')
+        y_sorted = y[order]
+        starts = np.flatnonzero(np.concatenate(([True], y_sorted[1:] != y_sorted[:-1])))
+        self._class_sum[y_sorted[starts]] += np.add.reduceat(X[order], starts, axis=0)
+        self.class_count[y_sorted[starts]] += np.diff(np.concatenate((starts, [n])))
+
+    def merge(self, other):
+        "Merges the statistics of another set of images (with the same classes) into these ones."
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta*(other.count/float(total))
+        self._m2 += other._m2 + delta**2*(self.count*other.count/float(total))
+        self.count = total
+        self.class_count += other.class_count
+        self._class_sum += other._class_sum
+
+    @property
+    def std(self):
+        "Standard deviation of each pixel."
+        return np.sqrt(self._m2/max(1, self.count))
+
+    @property
+    def channel_mean(self):
+        "Mean of each color channel (a single value for black&white images)."
+        axis = _channel_axis(self.shape)
+        if axis is None:
+            return self.mean.mean().reshape((1,))
+        return np.moveaxis(self.mean, axis, 0).reshape((self.shape[axis], -1)).mean(axis=1)
+
+    @property
+    def channel_std(self):
+        "Standard deviation of each color channel (a single value for black&white images)."
+        axis = _channel_axis(self.shape)
+        if axis is None:
+            mean, m2 = self.mean.reshape((1, -1)), self._m2.reshape((1, -1))
+        else:
+            mean = np.moveaxis(self.mean, axis, 0).reshape((self.shape[axis], -1))
+            m2 = np.moveaxis(self._m2, axis, 0).reshape((self.shape[axis], -1))
+        # All pixels of a channel have the same number of samples: merge them
+        channel_mean = mean.mean(axis=1, keepdims=True)
+        var = (m2.sum(axis=1) + self.count*((mean - channel_mean)**2).sum(axis=1))/max(1, self.count*mean.shape[1])
+        return np.sqrt(var)
+
+    @property
+    def class_mean(self):
+        "Mean image of each class."
+        return self._class_sum/np.maximum(1, self.class_count).reshape((-1,) + (1,)*len(self.shape))
+
+    def save(self, f, suffix=''):
+        "Saves the statistics in the HDF5 file f, replacing the previous ones. suffix designates the size of the images, e.g. '_32' for X_32."
+        for name, data, dtype in [
+            ('mean', self.mean[np.newaxis, ...], 'f'),
+            ('std', self.std[np.newaxis, ...], 'f'),
+            ('channel_mean', self.channel_mean, 'f'),
+            ('channel_std', self.channel_std, 'f'),
+            ('class_mean', self.class_mean, 'f'),
+            ('class_count', self.class_count, 'i')]:
+            if name + suffix in f:
+                del f[name + suffix]
+            f.create_dataset(name + suffix, data.shape, dtype, data)
+        f.attrs['nb_statistics' + suffix] = self.count
+
+    @classmethod
+    def load(cls, f, suffix=''):
+        "Loads the statistics saved in the HDF5 file f. suffix designates the size of the images, e.g. '_32' for X_32."
+        stats = cls(f['mean' + suffix].shape[1:], f['class_count' + suffix].shape[0])
+        stats.count = int(f.attrs['nb_statistics' + suffix])
+        stats.mean = np.array(f['mean' + suffix][0], dtype='float64')
+        stats._m2 = np.array(f['std' + suffix][0], dtype='float64')**2*stats.count
+        stats.class_count = np.array(f['class_count' + suffix], dtype='int64')
+        stats._class_sum = np.array(f['class_mean' + suffix], dtype='float64')*stats.class_count.reshape((-1,) + (1,)*len(stats.shape))
+        return stats
+
+def _compute_statistics(f, nb_images=None, batch_size=1000, suffix=''):
+    "Computes the statistics of the nb_images first images of the dataset 'X' + suffix of the opened HDF5 file f in one chunked pass."
+    dset_X, dset_Y = f['X' + suffix], f['Y']
+    if nb_images is None:
+        nb_images = dset_X.shape[0]
+    scale = 1./255. if dset_X.dtype == np.uint8 else 1. # the statistics are always in [0, 1]
+    stats = RunningStatistics(dset_X.shape[1:], f['labels'].shape[0])
+    # Read whole chunks at once
+    if dset_X.chunks is not None:
+        batch_size = max(1, batch_size//dset_X.chunks[0])*dset_X.chunks[0]
+    for start in range(0, nb_images, batch_size):
+        stop = min(start + batch_size, nb_images)
+        stats.update(scale*dset_X[start:stop, ...], dset_Y[start:stop])
+    return stats
+
+def compute_statistics(filename, batch_size=1000):
+    """
+    Computes the statistics of an existing HDF5 file in one chunked pass and saves them in it.
+
+    The statistics are the mean image (`mean`), the standard deviation of each pixel (`std`), the mean and standard deviation of each color channel (`channel_mean`, `channel_std`), and the mean image of each class (`class_mean`, with the number of images in `class_count`). They are computed on images in [0, 1], whatever the storage type, and for each size of the images if the file contains several ones. Files generated with the current version of `generate_ytf_database` already contain them.
+
+    Parameters:
+
+    * `filename`: path to the HDF5 file.
+    * `batch_size`: number of images read at once (default: 1000).
+    """
+    tstart = time()
+    f = h5py.File(filename, "r+")
+    for suffix in _suffixes(f):
+        stats = _compute_statistics(f, batch_size=batch_size, suffix=suffix)
+        stats.save(f, suffix)
+    f.close()
+    print('Statistics of', stats.count, 'images computed in', time()-tstart, 'seconds.')
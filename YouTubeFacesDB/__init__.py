@@ -1,2 +1,8 @@
-from Generator import generate_ytf_database
-from Dataset import YouTubeFacesDB
+from .Generator import generate_ytf_database, merge_shards
+from .Dataset import YouTubeFacesDB
+from .Cache import ChunkCache
+from .Index import SampleIndex
+from .Statistics import compute_statistics
+from .Backend import export_npy, MultiFile
+from .Augmentation import Augmentation, Compose, RandomCrop, CenterCrop, RandomShift, RandomFlip, RandomBrightness
+from .Profiler import Profiler
@@ -16,7 +16,8 @@ from keras.utils import np_utils
 ###############################################################################
 tstart = time()
 
-db = YouTubeFacesDB('ytfdb.h5', mean_removal=True, output_type='vector')
+# The validation set is kept in memory if it fits in 1GB
+db = YouTubeFacesDB('ytfdb.h5', mean_removal=True, output_type='vector', cache_bytes=1024**3)
 N = db.nb_samples
 d = db.input_dim
 C = db.nb_classes